@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""codec and gateway throughput, written as JSON
+
+    python benchmark.py [--quick] [--output FILE] [--baseline FILE]
+
+Every result has ops_per_sec and the per operation latency (mean, p50,
+p99) in microseconds. With --baseline, any result whose ops_per_sec fell
+more than --tolerance below the baseline is reported and the exit status
+is 1.
+"""
+
+import os
+# debug logging would dominate every number
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import sys
+import json
+import socket
+import threading
+import time
+import timeit
+import platform
+import serial
+from taiseia101 import taiseia101
+from taiseia101 import dehumiditifer
+from taiseia101 import eventloop
+from taiseia101 import gateway
+
+REGISTER_HEX = ('45,00,00,04,00,03,00,04,50,61,6e,61,73,6f,6e,69,63,00,46,59,54,57,2d,30,35,37,'
+                '36,30,31,32,31,00,80,00,03,81,00,7f,82,00,0c,84,00,06,07,00,00,89,00,0f,0a,00,'
+                '00,8d,00,03,8e,00,0f,12,00,00,98,00,03,9d,00,00,d6')
+STATUS_HEX = '06,04,07,00,37,32'
+
+clock = timeit.default_timer
+
+def summarize(samples, total):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n': n,
+        'ops_per_sec': n / total if total > 0 else 0.0,
+        'mean_us': sum(samples) / n * 1e6,
+        'p50_us': samples[n // 2] * 1e6,
+        'p99_us': samples[min(n - 1, int(n * 0.99))] * 1e6,
+        }
+
+def bench(fn, n):
+    samples = []
+    start = clock()
+    for _ in range(n):
+        t = clock()
+        fn()
+        samples.append(clock() - t)
+    return summarize(samples, clock() - start)
+
+def codec_benchmarks(n):
+    register_frame = bytearray(int(x, 16) for x in REGISTER_HEX.split(','))
+    status_frame = bytearray(int(x, 16) for x in STATUS_HEX.split(','))
+    request = dehumiditifer.service_write(dehumiditifer._srv_PowerControl,
+                                          dehumiditifer.ServicePower.ON)
+    status = dehumiditifer.parse_response_bytes(status_frame)
+    return {
+        'request_call': bench(request, n),
+        'request_encode': bench(request.encode, n),
+        'taiseia101_parse_response_pocket':
+            bench(lambda: taiseia101.parse_response_pocket(STATUS_HEX), n),
+        'dehumiditifer_parse_response_pocket':
+            bench(lambda: dehumiditifer.parse_response_pocket(STATUS_HEX), n),
+        'taiseia101_parse_response_bytes':
+            bench(lambda: taiseia101.parse_response_bytes(status_frame), n),
+        'dehumiditifer_parse_response_bytes':
+            bench(lambda: dehumiditifer.parse_response_bytes(status_frame), n),
+        'register_response_pocket':
+            bench(lambda: taiseia101.RegisterResponsePocket(register_frame), n),
+        'register_pocket_json':
+            bench(lambda: dehumiditifer.parse_response_bytes(register_frame).to_json(), n),
+        'response_str': bench(lambda: str(status), n),
+        'response_json': bench(status.to_json, n),
+        }
+
+class LoopGateway(object):
+    """Gateway with one loop:// device, its event loop in a thread"""
+
+    def __init__(self):
+        self.loop = eventloop.EventLoop()
+        self.gw = gateway.Gateway(self.loop, localport=0, host='127.0.0.1',
+                                  output_format='ndjson')
+        command_registry = dehumiditifer.command_registry()
+        ser = serial.serial_for_url('loop://', baudrate=9600)
+        self.gw.add_device(gateway.SerialDevice(
+            self.loop, 'loop', ser,
+            compile_command=command_registry.compile,
+            parse_frame=dehumiditifer.parse_response_bytes))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.gw.start()
+        self.thread.start()
+        return self.gw.srv.getsockname()[1]
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.gw.stop()
+        self.loop.close()
+
+class LineClient(object):
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(5)
+        self.buff = b''
+
+    def readline(self):
+        while b'\n' not in self.buff:
+            data = self.sock.recv(65536)
+            if not data:
+                raise IOError('gateway closed the connection')
+            self.buff += data
+        line, self.buff = self.buff.split(b'\n', 1)
+        return line
+
+    def send(self, line):
+        self.sock.sendall(line + b'\n')
+
+    def close(self):
+        self.sock.close()
+
+def gateway_benchmarks(n):
+    results = {}
+    with LoopGateway() as port:
+        client = LineClient(port)
+        # warm up the connection and the frame cache
+        client.send(b'power')
+        client.readline()
+
+        def round_trip():
+            client.send(b'power')
+            client.readline()
+        results['gateway_round_trip'] = bench(round_trip, n)
+
+        # pipelined: throughput of n commands in flight at once,
+        # latency is each reply's time since its own command went out;
+        # every read has its own (type, service) so none is merged
+        lines = [taiseia101.frame_hex(taiseia101.encode_request(1 + i // 0x80, True, i % 0x80))
+                 for i in range(n)]
+        sent = []
+        start = clock()
+        for line in lines:
+            sent.append(clock())
+            client.send(line)
+        samples = []
+        for t in sent:
+            client.readline()
+            samples.append(clock() - t)
+        results['gateway_pipelined'] = summarize(samples, clock() - start)
+        client.close()
+    return results
+
+def compare(results, baseline, tolerance):
+    """names of results slower than baseline by more than tolerance"""
+    slower = []
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1.0 - tolerance):
+            slower.append(name)
+    return slower
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='TaiSEIA codec and gateway benchmark')
+    parser.add_argument('--quick', action='store_true', default=False,
+                        help='fewer iterations, for a smoke run')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed ops/sec drop against the baseline, default: %(default)s')
+    parser.add_argument('--no-gateway', action='store_true', default=False,
+                        help='skip the loop:// gateway round trips')
+    args = parser.parse_args()
+
+    codec_n, gateway_n = (2000, 200) if args.quick else (50000, 2000)
+    results = codec_benchmarks(codec_n)
+    if not args.no_gateway:
+        results.update(gateway_benchmarks(gateway_n))
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+        }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for name in slower:
+            sys.stderr.write('regression: %s\n' % name)
+        if slower:
+            sys.exit(1)
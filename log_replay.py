@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""per device and service statistics from gateway logs, written as JSON
+
+    python log_replay.py [--workers N] [--no-timelines] [--output FILE] LOG [LOG ...]
+
+Reads the 'data frame hex:' and 'send bytes command' lines the gateway
+logs (gzip files too), pairs every command with its response and
+reports request counts, timeouts, unsupported values, response latency
+and the value changes of every service. Commands are only logged at
+LOG_LEVEL=DEBUG; without them there are timelines but no latency.
+Give rotated files oldest first.
+"""
+
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import sys
+import json
+import time
+from taiseia101 import dehumiditifer  # noqa, registers the dehumidifier service names
+from taiseia101 import replay
+
+if __name__ == '__main__':  # noqa
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Replay TaiSEIA 101 gateway frame logs into per service statistics')
+
+    parser.add_argument(
+        'logs',
+        nargs='+',
+        metavar='LOG',
+        help='log files in time order, .gz files are decompressed')
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='decoding processes, 0 decodes in this process, default: one per CPU',
+        default=None)
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='log lines per decoding batch, default: %(default)s',
+        default=2000)
+
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='seconds after which a command without a response counts as a timeout, '
+             'default: %(default)s',
+        default=2.0)
+
+    parser.add_argument(
+        '--no-timelines',
+        action='store_true',
+        help='leave the value timelines out of the output',
+        default=False)
+
+    parser.add_argument(
+        '--output',
+        metavar='FILE',
+        help='write the JSON here instead of stdout',
+        default=None)
+
+    args = parser.parse_args()
+
+    start = time.time()
+    analyzer = replay.LogAnalyzer(args.timeout)
+    for records in replay.batches(replay.decode(args.logs, args.workers, args.batch_size), 10000):
+        analyzer.feed(records)
+    analyzer.finish()
+    result = analyzer.to_dict(timelines=not args.no_timelines)
+    result['elapsed'] = time.time() - start
+
+    if args.output is None:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    sys.stderr.write('%s frame records in %.1fs\n' % (result['records'], result['elapsed']))
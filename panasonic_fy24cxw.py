@@ -17,11 +17,26 @@ import serial
 import serial.threaded
 import time
 import threading
+import json
+import functools
 import Queue
 # import requests
 # from requests.auth import HTTPBasicAuth
 from taiseia101 import taiseia101
 from taiseia101 import dehumiditifer
+from taiseia101 import framing
+from taiseia101 import eventloop
+from taiseia101 import gateway
+from taiseia101 import worker
+from taiseia101 import fanout
+from taiseia101 import wire
+from taiseia101 import regcache
+from taiseia101 import metrics
+from taiseia101 import cmdqueue
+from taiseia101 import historian
+from taiseia101 import transaction
+from taiseia101 import statetable
+from taiseia101 import subscription
 
 class SocketClientThread(threading.Thread):
     def __init__(self, group=None, target=None, name=None,
@@ -32,15 +47,73 @@ class SocketClientThread(threading.Thread):
         self.kwargs = kwargs
         self.client_socket = None
         self.client_ip = None
+        self.client_name = None
+        self.send_queue = None
+        self.output_format = wire.FORMAT_JSON
+        # shared subscription.Subscribers; a subscribed client only gets
+        # the values it subscribed to and the replies to its own commands
+        # instead of every frame
+        self.subscribers = None
+        self.serial_to_net = None
+        self.device_id = None
         self._stop = threading.Event()
 
     def stop(self):
         self._stop.set()
+        self.send_queue.close()
         self.client_socket.close()
         
     def stopped(self):
         return self._stop.isSet()
 
+    def send(self, data):
+        """queue data for the sender thread, never blocks the caller"""
+        if self.stopped():
+            return
+        if not self.send_queue.put(data):
+            logger.warning('sck client(%s) too slow, %s messages queued, disconnect' % 
+                           (self.client_ip, len(self.send_queue)))
+            self.stop()
+
+    def send_message(self, msg):
+        data = wire.encode_message(msg, self.output_format)
+        if data is not None:
+            self.send(data)
+
+    def set_format(self, fmt):
+        if fmt not in wire.FORMATS:
+            self.send_message({'command': 'format %s' % fmt, 'error': 'unknown format'})
+        else:
+            self.send_message({'format': fmt})
+            self.output_format = fmt
+
+    def subscription_error(self, cmd, error):
+        # binary and raw have no messages, a line is better than silence
+        fmt = (self.output_format if self.output_format in wire.MESSAGE_FORMATS
+               else wire.FORMAT_NDJSON)
+        self.send(wire.encode_message({'command': cmd, 'error': error}, fmt))
+
+    def subscribe(self, cmd, verb, device_id, args):
+        if self.output_format not in wire.MESSAGE_FORMATS:
+            self.subscription_error(cmd, 'subscribe in json or ndjson format')
+            return
+        if device_id not in (subscription.ANY_DEVICE, self.device_id):
+            self.subscription_error(cmd, 'unknown device')
+            return
+        sub = self.subscribers.command(self, verb, device_id, args)
+        self.send_message({'subscriptions': sub.to_dict()})
+
+    def send_loop(self):
+        while not self.stopped():
+            data = self.send_queue.get(timeout=1)
+            if data is None:
+                continue
+            try:
+                self.client_socket.sendall(data)
+            except socket.error as msg:
+                logger.error('sck client(%s) send ERROR: %s' % (self.client_ip,msg))
+                self.stop()
+
     def run(self):
         # More quickly detect bad clients who quit without closing the
         # connection: After 1 second of idle, start sending TCP keep-alive
@@ -52,6 +125,9 @@ class SocketClientThread(threading.Thread):
         client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
         client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         client_socket.settimeout(3)
+        sender = threading.Thread(target=self.send_loop)
+        sender.daemon = True
+        sender.start()
         try:
             while not self.stopped():
                 try:
@@ -59,10 +135,32 @@ class SocketClientThread(threading.Thread):
                     if not data:
                         break
                     logger.info('sck client(%s) data: %s' % (self.client_ip,data))
+                    fmt = wire.parse_format_command(data.strip())
                     if data[:4] == 'exit':
                         self.stop()
+                    elif fmt is not None:
+                        self.set_format(fmt)
                     else:
-                        q.put(data)
+                        for cmd in data.splitlines():
+                            cmd = cmd.strip()
+                            if not cmd:
+                                continue
+                            try:
+                                sub_cmd = subscription.parse_command(cmd)
+                            except ValueError as e:
+                                self.subscription_error(cmd, str(e))
+                                continue
+                            if sub_cmd is not None:
+                                self.subscribe(cmd, *sub_cmd)
+                                continue
+                            frame = compile_command(cmd)
+                            if len(frame) > 0:
+                                if self in self.subscribers:
+                                    self.serial_to_net.expect(self, frame)
+                                q.put(frame)
+                            else:
+                                logger.debug('no data for serial port')
+                                self.send_message({'command': cmd, 'error': 'invalid command'})
                 except socket.timeout:
                     #logger.debug('sck client(%s) recv timeout, ignore' % (self.client_ip))
                     pass
@@ -78,7 +176,11 @@ class SocketClientThread(threading.Thread):
             logger.info('sck client(%s) Disconnected' % (self.client_ip))
             self.client_socket.close()
             self.stop()
+            self.subscribers.remove(self)
         
+command_registry = dehumiditifer.command_registry()
+compile_command = command_registry.compile
+
 class SerialQueueThread(threading.Thread):
     def __init__(self, group=None, target=None, name=None,
                  args=(), kwargs=None, verbose=None):
@@ -89,6 +191,14 @@ class SerialQueueThread(threading.Thread):
         self.queue = None
         self.queue_read_timeout = 3 # 3 seconds
         self.ser = None
+        self.latency = None
+        # transaction keys of the frames the serial reader decodes; the
+        # next command waits for the response key of this one up to the
+        # adaptive timeout of rtt, retrying as transaction.repeatable allows
+        self.responses = None
+        self.rtt = transaction.RttEstimator()
+        self.retries = 0
+        self.repeatable_writes = ()
         self._stop = threading.Event()
         return
     
@@ -102,114 +212,79 @@ class SerialQueueThread(threading.Thread):
     def run(self):
         logger.debug('serial queue thread (daemon: %s) running ...' % self.daemon)
         while True:
-            cmd = ''
             try:
                 cmd = self.queue.get(timeout=self.queue_read_timeout)
-                cmd = cmd.replace('\r\n','')
-                logger.debug('recv queue cmd: %s' % cmd)
-                if not self.ser is None:
-                    if cmd.lower() == 'register':
-                        pocket = taiseia101.RegisterRequestPocket()
-                        data = pocket()
-                    elif cmd.lower().find('power') == 0:
-                        if cmd.lower() == 'power':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_PowerControl)
-                        elif cmd.lower() == 'poweron':
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_PowerControl, 
-                                                                 dehumiditifer.ServicePower.ON)
-                        elif cmd.lower() == 'poweroff':
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_PowerControl, 
-                                                                 dehumiditifer.ServicePower.OFF)
-                        data = pocket()
-                    elif cmd.lower().find('opmode') == 0:
-                        if cmd.lower() == 'opmode':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_OpModeConfig)
-                        else:
-                            mode_id = cmd.lower().replace('opmode', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_OpModeConfig, 
-                                                                 int(mode_id))
-                        data = pocket()
-                    elif cmd.lower().find('fanlevel') == 0:
-                        if cmd.lower() == 'fanlevel':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_FanLevelConfig)
-                        else:
-                            level = cmd.lower().replace('fanlevel', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_FanLevelConfig, 
-                                                                 int(level))
-                        data = pocket()
-                    elif cmd.lower().find('swinglevel') == 0:
-                        if cmd.lower() == 'swinglevel':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_SwingLevelConfig)
-                        else:
-                            level = cmd.lower().replace('swinglevel', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_SwingLevelConfig, 
-                                                                 int(level))
-                        data = pocket()
-                    elif cmd.lower().find('timehr') == 0:
-                        if cmd.lower() == 'timehr':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_OpTimeHrConfig)
-                        else:
-                            hours = cmd.lower().replace('timehr', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_OpTimeHrConfig, 
-                                                                 int(hours))
-                        data = pocket()
-                    elif cmd.lower().find('dehumidify') == 0:
-                        if cmd.lower() == 'dehumidify':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_DehumiditiferLevelConfig)
-                        else:
-                            level = cmd.lower().replace('dehumidify', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_DehumiditiferLevelConfig, 
-                                                                 int(level))
-                        data = pocket()
-                    elif cmd.lower().find('airclean') == 0:
-                        if cmd.lower() == 'airclean':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_AirCleanModeConfig)
-                        else:
-                            level = cmd.lower().replace('airclean', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_AirCleanModeConfig, 
-                                                                 int(level))
-                        data = pocket()
-                    elif cmd.lower().find('sound') == 0:
-                        if cmd.lower() == 'sound':
-                            pocket = dehumiditifer.service_read(dehumiditifer._srv_SAAControlSound)
-                        else:
-                            value = cmd.lower().replace('sound', '').strip()
-                            pocket = dehumiditifer.service_write(dehumiditifer._srv_SAAControlSound, 
-                                                                 int(value))
-                        data = pocket()
-                    else:
-                        # hex string to byte array
-                        try:
-                            data = bytearray([int(entry,16) for entry in cmd.split(',')])
-                        except ValueError:
-                            data = []
-                            logger.warning('recv HA cmd format invalue: %s, ignore' % cmd)
-                    
-                    if len(data) > 0:
-                        data_hex = ','.join('{:02x}'.format(x) for x in data)
-                        logger.debug('send bytes command %s' % data_hex)
-                        ser.write(data)
-                    else:
-                        logger.debug('no data for serial port')
-
-            except Queue.Empty:
-                #logger.debug('serial cmd queue recv timeout')
-                pass
+                if cmd is not None and not self.ser is None:
+                    if cmd.merged:
+                        logger.debug('%s queued commands merged into one' % (cmd.merged + 1))
+                    self.queue.sent(cmd)
+                    try:
+                        self.transmit(cmd.data)
+                    finally:
+                        self.queue.finished(cmd.key)
             finally:
                 if self.stopped():
                     break
         logger.debug('-- serial queue thread exit --')
+
+    def transmit(self, data):
+        key = transaction.request_key(data)
+        retries = self.retries if transaction.repeatable(data, self.repeatable_writes) else 0
+        if self.latency is not None:
+            self.latency.sent(data)
+        for attempt in range(retries + 1):
+            if attempt:
+                logger.info('no response to %s, retransmit %s' % (key, attempt))
+            if self.responses is not None:
+                self._drain_responses()
+            logger.debug('send bytes command %s' % taiseia101.frame_hex(data))
+            sent = time.time()
+            self.ser.write(data)
+            if self.responses is None or key is None:
+                return
+            if self._wait_response(key, sent + self.rtt.timeout()):
+                if not attempt:
+                    self.rtt.observe(time.time() - sent)
+                return
+            self.rtt.backoff()
+
+    def _drain_responses(self):
+        try:
+            while True:
+                self.responses.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _wait_response(self, key, deadline):
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                if self.responses.get(timeout=remaining) == key:
+                    return True
+            except Queue.Empty:
+                return False
     
 class SerialToNet(serial.threaded.Protocol):
     """serial->socket"""
 
-    buff = []
-    
     def __init__(self):
         self.client_threads = []
-        self.buff = []
+        self.decoder = framing.FrameDecoder()
         self.connected = False
         self.cmd_queue = None
+        self.latency = None
+        self.historian = None
+        self.state_table = None
+        self.subscribers = subscription.Subscribers()
+        # response key -> subscribed clients waiting for that reply
+        self.waiting = {}
+        self.waiting_lock = threading.Lock()
+        self.device_id = None
+        self.device_type_id = None
+        # transaction keys of decoded frames, for SerialQueueThread
+        self.responses = Queue.Queue(64)
 
     def __call__(self):
         return self
@@ -225,26 +300,178 @@ class SerialToNet(serial.threaded.Protocol):
     def data_received(self, data):
         data_hex = ','.join('{:02x}'.format(ord(x)) for x in data)
         logger.debug('serial recv %s' % (data_hex))
-        for x in data:
-            #logger.debug('buff append data %s len %s' % (type(x),len(x)))
-            self.buff.append(ord(x))
-            if self.buff[0] == len(self.buff):
-#                 from panasonic.taiseia101 import taiseia101
-                logger.debug('data frame receive complete')
-                data_hex = ','.join('{:02x}'.format(x) for x in self.buff)
-                logger.info('data frame hex: %s' % data_hex)
-#                 pocket = taiseia101.parse_response_pocket(data_hex)
-                pocket = dehumiditifer.parse_response_pocket(data_hex)
-                logger.debug('recv pocket: %s, %s' % (pocket.__class__.__name__,str(pocket)))
-#                 if pocket.device_type['id'] == 0x13:
-#                     for pdu in pocket.service_pdu_list:
-#                         service = taiseia101.fan.FanServie(pdu)
-#                         logger.info('fan service: %s\n' % str(service.getJson()))
-                self.buff = []
-                
-                logger.debug('send data frame hex string for all socket clients')
-                for sck_client in self.client_threads:
-                    sck_client.client_socket.sendall(str(pocket)+'\n')
+        dropped_bytes = self.decoder.dropped_bytes
+        for frame in self.decoder.feed(data):
+            logger.debug('data frame receive complete')
+            data_hex = ','.join('{:02x}'.format(x) for x in frame)
+            logger.info('data frame hex: %s' % data_hex)
+            key = transaction.response_key(frame)
+            if self.cmd_queue is not None:
+                # reads joining from now on need a new round trip
+                self.cmd_queue.finished(key)
+            try:
+                self.responses.put_nowait(key)
+            except Queue.Full:
+                pass
+            if self.latency is not None:
+                self.latency.received(frame)
+            pocket = dehumiditifer.parse_response_bytes(frame)
+            if pocket is None:
+                continue
+            logger.debug('recv pocket: %s, %s' % (pocket.__class__.__name__,str(pocket)))
+            if (isinstance(pocket, taiseia101.RegisterResponsePocket) or 
+                    frame[1] != taiseia101._type_Register):
+                self.device_type_id = pocket.type_id
+            if self.historian is not None:
+                self.historian.record_pocket(self.device_id, pocket, self.device_type_id)
+            if self.state_table is not None:
+                self.state_table.publish_pocket(self.device_id, pocket, self.device_type_id)
+            
+            if len(self.subscribers):
+                self.push(pocket)
+            with self.waiting_lock:
+                asked = self.waiting.pop(key, ())
+            logger.debug('send data frame hex string for all socket clients')
+            encoder = wire.Encoder(pocket)
+            for sck_client in list(self.client_threads):
+                if sck_client in asked or sck_client not in self.subscribers:
+                    sck_client.send(encoder(sck_client.output_format))
+        if self.decoder.dropped_bytes != dropped_bytes:
+            logger.warning('serial frame resync, dropped %s bytes (total %s)' % 
+                           (self.decoder.dropped_bytes - dropped_bytes,
+                            self.decoder.dropped_bytes))
+
+
+    def expect(self, sck_client, frame):
+        """sck_client sent frame and gets its reply even when subscribed"""
+        key = transaction.request_key(frame)
+        if key is not None:
+            with self.waiting_lock:
+                self.waiting.setdefault(key, set()).add(sck_client)
+
+    def push(self, pocket):
+        for type_id, service_id, value in taiseia101.response_values(pocket, self.device_type_id):
+            for sck_client in self.subscribers.matches(self.device_id, service_id, value):
+                data = wire.encode_value(self.device_id, type_id, service_id, value,
+                                         pocket.timestamp, sck_client.output_format)
+                if data is not None:
+                    sck_client.send(data)
+
+
+def open_serial(config, args):
+    ser = serial.serial_for_url(config['url'], do_not_open=True)
+    ser.baudrate = config.get('baudrate', args.BAUDRATE)
+    ser.parity = config.get('parity', args.parity)
+    ser.rtscts = config.get('rtscts', args.rtscts)
+    ser.xonxoff = config.get('xonxoff', args.xonxoff)
+    if args.rts is not None:
+        ser.rts = args.rts
+    if args.dtr is not None:
+        ser.dtr = args.dtr
+    if not args.quiet:
+        logger.info(
+            '--- {id} TCP/IP to Serial redirect on {p.name}  {p.baudrate},{p.bytesize},{p.parity},{p.stopbits} ---'.format(
+                id=config['id'], p=ser))
+    ser.open()
+    return ser
+
+def repeatable_writes():
+    return [(taiseia101._type_Dehumiditifer, service_id)
+            for service_id in dehumiditifer.repeatable_writes]
+
+def make_historian(args):
+    if args.history_dir is None:
+        return None
+    services = [(taiseia101._type_Dehumiditifer, service_id)
+                for service_id in dehumiditifer.history_services]
+    return historian.Historian(args.history_dir, services, raw_capacity=args.history_samples)
+
+def make_state_table(args):
+    if args.state_table is None:
+        return None
+    return statetable.StateTable(args.state_table, args.state_devices)
+
+def make_device(loop, config, args, metrics=None):
+    ser = open_serial(config, args)
+    cache = None
+    if args.registration_cache is not None:
+        cache = regcache.RegistrationCache(args.registration_cache)
+    device = gateway.SerialDevice(loop, config['id'], ser, 
+                                  compile_command=compile_command,
+                                  parse_frame=dehumiditifer.parse_response_bytes,
+                                  request_timeout=args.request_timeout,
+                                  shadow_ttl=args.shadow_ttl,
+                                  registration_cache=cache,
+                                  metrics=metrics,
+                                  max_in_flight=args.max_in_flight,
+                                  historian=make_historian(args),
+                                  retries=args.retries,
+                                  repeatable_writes=repeatable_writes(),
+                                  state_table=make_state_table(args))
+    if args.poll:
+        intervals = dict(dehumiditifer.poll_intervals)
+        for entry in args.poll_interval:
+            name, seconds = entry.split('=')
+            intervals[taiseia101.registry.service_id(taiseia101._type_Dehumiditifer, name)] = float(seconds)
+        device.enable_polling(taiseia101._type_Dehumiditifer, intervals, args.poll_share)
+    return device
+
+def run_event_loop(args, configs):
+    for entry in args.poll_interval:
+        name = entry.split('=')[0]
+        if taiseia101.registry.service_id(taiseia101._type_Dehumiditifer, name) is None:
+            logger.error('unknown service in --poll-interval: %s' % name)
+            return 1
+    
+    loop = eventloop.EventLoop()
+    gateway_metrics = None
+    metrics_server = None
+    if args.metrics_port:
+        gateway_metrics = metrics.Metrics()
+        metrics.describe_gateway(gateway_metrics)
+        metrics_server = metrics.MetricsServer(
+            metrics.loop_renderer(loop, gateway_metrics), args.metrics_port, args.metrics_host)
+    gw = gateway.Gateway(loop, 
+                         localport=args.localport,
+                         broadcast_unsolicited=args.broadcast_unsolicited,
+                         client_queue=args.client_queue,
+                         slow_client_policy=args.slow_client,
+                         output_format=args.output_format,
+                         metrics=gateway_metrics)
+    workers = []
+    try:
+        if args.workers > 0:
+            factory = functools.partial(make_device, args=args)
+            for share in worker.spread(configs, args.workers):
+                w = worker.WorkerProcess(loop, share, factory, dehumiditifer.parse_response_bytes)
+                w.start()
+                workers.append(w)
+                for device in w.devices.values():
+                    gw.add_device(device)
+        else:
+            for config in configs:
+                gw.add_device(make_device(loop, config, args, gateway_metrics))
+    except serial.SerialException as e:
+        logger.error('Could not open serial port: {}'.format(e))
+        return 1
+
+    gw.start()
+    if metrics_server is not None:
+        metrics_server.start()
+    logger.info('--- type Ctrl-C / BREAK to quit')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.debug('stoping gateway ...')
+    if metrics_server is not None:
+        metrics_server.stop()
+    gw.stop()
+    for w in workers:
+        w.stop()
+    loop.close()
+    logger.warning('--- exit ---')
+    return 1
 
 
 if __name__ == '__main__':  # noqa
@@ -262,6 +489,7 @@ it waits for the next connect.
 
     parser.add_argument(
         'SERIALPORT',
+        nargs='?',
         help="serial port name")
 
     parser.add_argument(
@@ -324,8 +552,169 @@ it waits for the next connect.
         help='local TCP port, default: %(default)s',
         default=7778)
 
+    group.add_argument(
+        '--client-queue',
+        type=int,
+        help='messages queued for a client before it counts as slow, default: %(default)s',
+        default=256)
+
+    group.add_argument(
+        '--slow-client',
+        choices=fanout.POLICIES,
+        help='what to do with a slow client: disconnect it, drop its oldest messages, '
+             'or sample only every 4th message once its queue is half full, default: %(default)s',
+        default=fanout.POLICY_DISCONNECT)
+
+    group.add_argument(
+        '--output-format',
+        choices=wire.FORMATS,
+        help='default format of the pockets sent to clients, a client may pick its own '
+             'with "format <name>", default: %(default)s',
+        default=wire.FORMAT_JSON)
+
+    group.add_argument(
+        '--metrics-port',
+        type=int,
+        help='serve Prometheus metrics on this local HTTP port, 0 disables, default: %(default)s',
+        default=0)
+
+    group.add_argument(
+        '--metrics-host',
+        help='address the metrics port listens on, default: %(default)s',
+        default='127.0.0.1')
+
+    group.add_argument(
+        '--event-loop',
+        action='store_true',
+        help='serve all TCP clients from one event loop instead of a thread per client (default off)',
+        default=False)
+
+    group.add_argument(
+        '--request-timeout',
+        type=float,
+        help='longest wait for a command response before the next command goes out, '
+             'the wait adapts to the measured response time below it, default: %(default)s',
+        default=2.0)
+
+    group.add_argument(
+        '--retries',
+        type=int,
+        help='times a read, or a write that is safe to repeat, goes out again '
+             'without a response, default: %(default)s',
+        default=2)
+
+    group.add_argument(
+        '--max-in-flight',
+        type=int,
+        help='event loop mode, commands sent to a device before its responses arrive, '
+             'default: %(default)s',
+        default=1)
+
+    group.add_argument(
+        '--broadcast-unsolicited',
+        action='store_true',
+        help='event loop mode, send frames no client asked for to all clients (default off)',
+        default=False)
+
+    group.add_argument(
+        '--shadow-ttl',
+        type=float,
+        help='event loop mode, answer reads from values younger than this many seconds, 0 disables, default: %(default)s',
+        default=0)
+
+    group.add_argument(
+        '--poll',
+        action='store_true',
+        help='event loop mode, poll the dehumidifier services in the background (default off)',
+        default=False)
+
+    group.add_argument(
+        '--poll-share',
+        type=float,
+        help='share of the serial bandwidth background polling may use, default: %(default)s',
+        default=0.5)
+
+    group.add_argument(
+        '--poll-interval',
+        action='append',
+        metavar='SERVICE=SECONDS',
+        help='override the poll interval of a service, e.g. RealTimeWatt=1, may be repeated',
+        default=[])
+
+    group.add_argument(
+        '--registration-cache',
+        metavar='FILE',
+        help='event loop mode, keep register responses per serial port in FILE and answer '
+             '"register" from it after a restart, checked against the device model',
+        default=None)
+
+    group.add_argument(
+        '--history-dir',
+        metavar='DIR',
+        help='record power and humidity readings per device in memory mapped files under DIR',
+        default=None)
+
+    group.add_argument(
+        '--history-samples',
+        type=int,
+        help='raw readings kept per device and service before only the minute and hour '
+             'aggregates are left, default: %(default)s',
+        default=8640)
+
+    group.add_argument(
+        '--state-table',
+        metavar='FILE',
+        help='publish the latest service values of every device in FILE, a memory mapped '
+             'table local processes read with taiseia101.statetable.StateReader, '
+             'e.g. /dev/shm/taiseia101',
+        default=None)
+
+    group.add_argument(
+        '--state-devices',
+        type=int,
+        help='device slots in the --state-table file, default: %(default)s',
+        default=16)
+
+    group.add_argument(
+        '--config',
+        help='event loop mode, JSON list of devices '
+             '[{"id": ..., "url": ..., "baudrate": ..., "parity": ...}, ...] '
+             'served on the one TCP port, address them as "@<id> <command>"',
+        default=None)
+
+    group.add_argument(
+        '--workers',
+        type=int,
+        help='event loop mode, spread the devices over this many worker processes, '
+             '0 serves them all from the main process, default: %(default)s',
+        default=0)
+
     args = parser.parse_args()
+
+    if args.poll_share <= 0:
+        parser.error('--poll-share must be greater than 0')
     
+    if args.config is not None or args.event_loop:
+        if args.config is not None:
+            with open(args.config) as f:
+                configs = json.load(f)
+            for config in configs:
+                # device ids go on the wire as plain str
+                config['id'] = str(config['id'])
+                config['url'] = str(config['url'])
+        elif args.SERIALPORT is not None:
+            configs = [{
+                'id': args.SERIALPORT,
+                'url': args.SERIALPORT,
+                'baudrate': args.BAUDRATE
+                }]
+        else:
+            parser.error('SERIALPORT or --config is required')
+        sys.exit(run_event_loop(args, configs))
+
+    if args.SERIALPORT is None:
+        parser.error('SERIALPORT is required')
+
     # connect to serial port
     ser = serial.serial_for_url(args.SERIALPORT, do_not_open=True)
     ser.baudrate = args.BAUDRATE
@@ -349,9 +738,9 @@ it waits for the next connect.
     except serial.SerialException as e:
         logger.error('Could not open serial port {}: {}\n'.format(ser.name, e))
         sys.exit(1)
-        
+    
     # setup serial port command queue
-    q = Queue.Queue()
+    q = cmdqueue.CommandQueue()
     client_threads = []
  
     # setup serial cmd receiver thread
@@ -364,8 +753,34 @@ it waits for the next connect.
     ser_to_net = SerialToNet()
     ser_to_net.cmd_queue = q
     ser_to_net.client_threads = client_threads
+    ser_to_net.device_id = args.SERIALPORT
+    ser_to_net.historian = make_historian(args)
+    ser_to_net.state_table = make_state_table(args)
+    ser_q_worker.responses = ser_to_net.responses
+    ser_q_worker.rtt = transaction.RttEstimator(max_timeout=args.request_timeout)
+    ser_q_worker.retries = args.retries
+    ser_q_worker.repeatable_writes = repeatable_writes()
     serial_worker = serial.threaded.ReaderThread(ser, ser_to_net)
     serial_worker.start()
+
+    metrics_server = None
+    if args.metrics_port:
+        gateway_metrics = metrics.Metrics()
+        metrics.describe_gateway(gateway_metrics)
+        latency = metrics.LatencyTracker(gateway_metrics, args.SERIALPORT)
+        ser_q_worker.latency = latency
+        ser_to_net.latency = latency
+        def metric_samples():
+            samples = metrics.decoder_samples(args.SERIALPORT, ser_to_net.decoder)
+            samples.append(('taiseia_command_queue_depth', {'device': args.SERIALPORT}, 
+                            len(q) + latency.depth()))
+            samples.extend(metrics.client_samples(
+                [(t.client_name, t.send_queue) for t in list(client_threads)]))
+            return samples
+        gateway_metrics.add_collector(metric_samples)
+        metrics_server = metrics.MetricsServer(gateway_metrics.render, 
+                                               args.metrics_port, args.metrics_host)
+        metrics_server.start()
     
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -386,6 +801,12 @@ it waits for the next connect.
                 client_thread = SocketClientThread()
                 client_thread.client_socket = client_socket
                 client_thread.client_ip = addr[0]
+                client_thread.client_name = '%s:%s' % addr
+                client_thread.send_queue = fanout.SendQueue(args.client_queue, args.slow_client)
+                client_thread.output_format = args.output_format
+                client_thread.subscribers = ser_to_net.subscribers
+                client_thread.serial_to_net = ser_to_net
+                client_thread.device_id = ser_to_net.device_id
                 client_thread.start()
                 client_threads.append(client_thread)
             except socket.timeout:
@@ -404,9 +825,16 @@ it waits for the next connect.
     except KeyboardInterrupt:
         pass
 
+    if metrics_server is not None:
+        metrics_server.stop()
+
     logger.debug('stoping serial_worker thread ...')
     serial_worker.stop()
     serial_worker.join()
+    if ser_to_net.historian is not None:
+        ser_to_net.historian.close()
+    if ser_to_net.state_table is not None:
+        ser_to_net.state_table.close()
 
     logger.debug('stoping ser_q_worker thread ...')
     ser_q_worker.stop()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import logging
+
+log_level = os.getenv('LOG_LEVEL', 'INFO')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+logging.basicConfig(level=numeric_level,format=FORMAT)
+logger = logging.getLogger('sa_emulator')
+
+import json
+from taiseia101 import eventloop
+from taiseia101 import emulator
+
+def make_port(loop, config, args, n):
+    device_id = str(config.get('id', 'sa%d' % n))
+    seed = None if args.seed is None else args.seed + n
+    appliance = emulator.dehumidifier(
+        services=config.get('services'),
+        values=config.get('values'),
+        brand=config.get('brand', 'Panasonic'),
+        model=config.get('model', 'FY24CXW-EMU'),
+        seed=seed)
+    faults = emulator.Faults(
+        drop=config.get('drop', args.drop),
+        bad_check_sum=config.get('bad_check_sum', args.bad_check_sum),
+        garbage=config.get('garbage', args.garbage),
+        truncate=config.get('truncate', args.truncate),
+        stall=config.get('stall', args.stall),
+        stall_time=config.get('stall_time', args.stall_time),
+        seed=seed)
+    kwargs = {
+        'faults': faults,
+        'delay': config.get('delay', args.delay),
+        'baudrate': config.get('baudrate', args.baudrate),
+        }
+    if config.get('url'):
+        return emulator.SerialUrlPort(loop, device_id, appliance, str(config['url']), **kwargs)
+    return emulator.PtyPort(loop, device_id, appliance, **kwargs)
+
+def log_stats(loop, ports, interval):
+    for port in ports:
+        logger.info('%s %s' % (port.device_id, json.dumps(port.stats(), sort_keys=True)))
+    loop.call_later(interval, log_stats, loop, ports, interval)
+
+if __name__ == '__main__':  # noqa
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Emulated TaiSEIA 101 dehumidifiers (SA side) for gateway load tests',
+        epilog="""\
+Each emulated appliance gets a pseudo terminal, or the pyserial URL given
+in --config. Point panasonic_fy24cxw.py at the ptys with the file written
+by --gateway-config.
+""")
+
+    parser.add_argument(
+        '-n', '--count',
+        type=int,
+        help='number of emulated appliances when no --config is given, default: %(default)s',
+        default=1)
+
+    parser.add_argument(
+        '--config',
+        help='JSON list of appliances [{"id": ..., "url": ..., "model": ..., '
+             '"services": [names], "values": {name: value}, "delay": ..., "drop": ...}, ...], '
+             'no url means a new pty',
+        default=None)
+
+    parser.add_argument(
+        '--links',
+        metavar='DIR',
+        help='symlink each pty as DIR/<id>',
+        default=None)
+
+    parser.add_argument(
+        '--gateway-config',
+        metavar='FILE',
+        help='write a panasonic_fy24cxw.py --config file for the emulated ports',
+        default=None)
+
+    parser.add_argument(
+        '--stats-interval',
+        type=float,
+        help='seconds between request/reply counter logs, 0 disables, default: %(default)s',
+        default=0)
+
+    group = parser.add_argument_group('timing')
+
+    group.add_argument(
+        '--delay',
+        type=float,
+        help='seconds an appliance takes to answer, default: %(default)s',
+        default=0.05)
+
+    group.add_argument(
+        '--baudrate',
+        type=int,
+        help='line speed the reply wire time is based on, default: %(default)s',
+        default=9600)
+
+    group = parser.add_argument_group('error injection, probability per reply')
+
+    group.add_argument('--drop', type=float, default=0.0, help='no reply')
+    group.add_argument('--bad-check-sum', type=float, default=0.0, help='flipped check sum')
+    group.add_argument('--garbage', type=float, default=0.0, help='random bytes before the reply')
+    group.add_argument('--truncate', type=float, default=0.0, help='only half the reply')
+    group.add_argument('--stall', type=float, default=0.0, help='reply held back --stall-time')
+    group.add_argument('--stall-time', type=float, default=1.0,
+                       help='seconds of a stall, default: %(default)s')
+    group.add_argument('--seed', type=int, default=None,
+                       help='random seed, for repeatable runs')
+
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config) as f:
+            configs = json.load(f)
+    else:
+        configs = [{} for _ in range(args.count)]
+
+    loop = eventloop.EventLoop()
+    ports = []
+    for n, config in enumerate(configs):
+        port = make_port(loop, config, args, n)
+        link = None
+        if args.links is not None and isinstance(port, emulator.PtyPort):
+            link = os.path.join(args.links, port.device_id)
+        port.start(link)
+        logger.info('%s %s on %s' % (port.device_id, port.appliance.model, port.path()))
+        ports.append(port)
+
+    if args.gateway_config is not None:
+        with open(args.gateway_config, 'w') as f:
+            json.dump([{'id': port.device_id, 'url': port.path(), 'baudrate': port.baudrate}
+                       for port in ports], f, indent=2)
+
+    if args.stats_interval > 0:
+        loop.call_later(args.stats_interval, log_stats, loop, ports, args.stats_interval)
+
+    logger.info('--- type Ctrl-C / BREAK to quit')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    for port in ports:
+        port.stop()
+        logger.info('%s %s' % (port.device_id, json.dumps(port.stats(), sort_keys=True)))
+    loop.close()
@@ -0,0 +1,146 @@
+import collections
+import threading
+import taiseia101
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+def merge_key(data):
+    """(type_id, service_id, is_read) of a request frame, None if too short
+
+    Unlike transaction.request_key, type 0 services stay apart: a
+    register request never merges with a services status request.
+    """
+    if len(data) < 3:
+        return None
+    head = bytearray(data[:3])
+    return (head[1], head[2] & 0x7f, not (head[2] & 0x80))
+
+class QueuedCommand(object):
+
+    def __init__(self, key, data, lane):
+        self.key = key
+        self.data = data
+        self.lane = lane
+        # whoever waits for the response: futures, or anything the owner keeps
+        self.waiters = []
+        self.merged = 0
+
+class CommandQueue(object):
+    """request frames waiting for the serial line
+
+    Two lanes: client commands go INTERACTIVE, polling and shadow refresh
+    go BACKGROUND. get() serves the interactive lane first, but after
+    starvation_limit interactive frames in a row with background frames
+    waiting, one background frame goes out.
+
+    A write to a service that already has a write waiting replaces that
+    write's value; a read identical to one waiting joins it. Either way
+    the waiters of both end up on one QueuedCommand, and an interactive
+    request joining a background one moves it to the interactive lane.
+    Frames without a transaction key are never merged.
+
+    Once the owner reports a read as sent(), identical reads join it
+    until finished(key) says its response (or timeout) is in, so
+    clients asking for the same value while it is on the line share one
+    round trip. Type 0 reads are left out: their responses do not carry
+    the service they answer.
+    """
+
+    def __init__(self, starvation_limit=4):
+        self.starvation_limit = starvation_limit
+        self.lanes = (collections.deque(), collections.deque())
+        self.by_key = {}
+        self.passed_over = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.lanes[INTERACTIVE]) + len(self.lanes[BACKGROUND])
+
+    def depth(self, lane):
+        return len(self.lanes[lane])
+
+    def put(self, data, lane=INTERACTIVE, waiter=None):
+        """queue data, return its QueuedCommand (maybe one already waiting)"""
+        key = merge_key(data)
+        with self.cond:
+            cmd = self.in_flight.get(key) if key is not None else None
+            if cmd is not None:
+                # the same read is on the line already
+                self.coalesced += 1
+                cmd.merged += 1
+                if waiter is not None:
+                    cmd.waiters.append(waiter)
+                return cmd
+            cmd = self.by_key.get(key) if key is not None else None
+            if cmd is None:
+                cmd = QueuedCommand(key, data, lane)
+                self.lanes[lane].append(cmd)
+                if key is not None:
+                    self.by_key[key] = cmd
+                self.cond.notify()
+            else:
+                self.coalesced += 1
+                cmd.merged += 1
+                if not key[2]:
+                    # a write: the latest value wins
+                    cmd.data = data
+                if lane == INTERACTIVE and cmd.lane == BACKGROUND:
+                    self.lanes[BACKGROUND].remove(cmd)
+                    self.lanes[INTERACTIVE].append(cmd)
+                    cmd.lane = INTERACTIVE
+            if waiter is not None:
+                cmd.waiters.append(waiter)
+            return cmd
+
+    def _pop(self):
+        interactive, background = self.lanes
+        if background and (not interactive or self.passed_over >= self.starvation_limit):
+            self.passed_over = 0
+            cmd = background.popleft()
+        elif interactive:
+            if background:
+                self.passed_over += 1
+            cmd = interactive.popleft()
+        else:
+            return None
+        if cmd.key is not None:
+            del self.by_key[cmd.key]
+        return cmd
+
+    def get_nowait(self):
+        """next QueuedCommand to send, None if there is none"""
+        with self.cond:
+            return self._pop()
+
+    def get(self, timeout=None):
+        """next QueuedCommand, blocking up to timeout seconds"""
+        with self.cond:
+            if not len(self):
+                self.cond.wait(timeout)
+            return self._pop()
+
+    def sent(self, cmd):
+        """cmd went out on the line, identical reads join it from now on"""
+        key = cmd.key
+        if key is None or not key[2] or key[0] == taiseia101._type_Register:
+            return
+        with self.cond:
+            self.in_flight[key] = cmd
+
+    def finished(self, key):
+        """the read on key got its response or gave up, the QueuedCommand or None"""
+        with self.cond:
+            return self.in_flight.pop(key, None)
+
+    def clear(self):
+        """drop everything waiting, return the dropped commands"""
+        with self.cond:
+            dropped = list(self.lanes[INTERACTIVE]) + list(self.lanes[BACKGROUND])
+            for lane in self.lanes:
+                lane.clear()
+            self.by_key.clear()
+            self.in_flight.clear()
+            return dropped
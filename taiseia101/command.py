@@ -0,0 +1,84 @@
+import re
+import logging
+import os
+import taiseia101
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+_command_re = re.compile(r'^([a-z_]+)\s*(\d+)?$')
+
+class CommandEntry(object):
+
+    def __init__(self, name, type_id, service_id, value=None):
+        self.name = name
+        self.type_id = type_id
+        self.service_id = service_id
+        self.value = value
+        if value is None:
+            self.frame = taiseia101.encode_request(type_id, True, service_id)
+        else:
+            self.frame = taiseia101.encode_request(type_id, False, service_id, value)
+
+class CommandRegistry(object):
+    """command line -> encoded request frame (bytes)
+
+    A command is a registered name, optionally followed by a value:
+    'fanlevel' reads the service, 'fanlevel 3' (or 'fanlevel3') writes 3.
+    Names registered with a fixed value ('poweron') always write it.
+    'register' and 'status' (every service value in one frame) are always
+    available. Any other line is taken as a comma separated hex frame.
+    """
+
+    def __init__(self, type_id):
+        self.type_id = type_id
+        self.commands = {}
+        self.register('register', taiseia101._srv_Register,
+                      type_id=taiseia101._type_Register)
+        self.register('status', taiseia101._srv_ReadDeviceServicesStatus,
+                      type_id=taiseia101._type_Register)
+
+    def register(self, name, service_id, value=None, type_id=None):
+        if type_id is None:
+            type_id = self.type_id
+        self.commands[name.lower()] = CommandEntry(name.lower(), type_id, service_id, value)
+
+    def register_services(self):
+        """register every service of the registry device type by its lower case name"""
+        for name, service_id in sorted(taiseia101.registry.services(self.type_id).items()):
+            if name.lower() not in self.commands:
+                self.register(name, service_id)
+
+    def names(self):
+        return sorted(self.commands.keys())
+
+    def lookup(self, cmd):
+        """cmd -> (CommandEntry, value to write or None), (None, None) if unknown"""
+        m = _command_re.match(cmd.strip().lower())
+        if m is None:
+            return None, None
+        entry = self.commands.get(m.group(1))
+        if entry is None:
+            return None, None
+        if m.group(2) is not None:
+            value = int(m.group(2))
+            if entry.value is not None or value > 0xffff:
+                return None, None
+            return entry, value
+        return entry, entry.value
+
+    def compile(self, cmd):
+        entry, value = self.lookup(cmd)
+        if entry is not None:
+            if value is None or value == entry.value:
+                return entry.frame
+            return taiseia101.encode_request(entry.type_id, False, entry.service_id, value)
+        # hex string to byte array
+        try:
+            return bytes(bytearray([int(x,16) for x in cmd.split(',')]))
+        except ValueError:
+            logging.warning('recv HA cmd format invalue: %s, ignore' % cmd)
+            return b''
@@ -1,7 +1,7 @@
 
 import sys
-import json
 import taiseia101
+import command
 import logging
 import os
 
@@ -44,37 +44,50 @@ _srv_TotalWatt = 0x1d
 _srv_EngMode = 0x50
 _srv_Reserved = 0x7f
 
+taiseia101.registry.register_device(taiseia101._type_Dehumiditifer, sys.modules[__name__])
+_service_names = taiseia101.registry.service_names[taiseia101._type_Dehumiditifer]
+
 def get_device_service_name_by_id(service_id):
-    current_module = sys.modules[__name__]
-    for entry in dir(current_module):
-        if entry.find('_srv_') == 0:
-            if getattr(current_module,entry) == service_id:
-                return entry.replace('_srv_','')
-    return ''
+    return _service_names.get(service_id, '')
 
 class RegisterPocket(taiseia101.RegisterResponsePocket):
     
-    def __init__(self, data):
-        taiseia101.RegisterResponsePocket.__init__(self, data)
-        for service in self.services:
-            service['service_name'] = get_device_service_name_by_id(service['service_id'])
+    __slots__ = ()
     
-    def __str__(self):
-        obj = json.loads(taiseia101.RegisterResponsePocket.__str__(self))
-        obj['services'] = self.services
+    def to_dict(self):
+        obj = taiseia101.RegisterResponsePocket.to_dict(self)
+        services = []
+        for service in self.services:
+            serv = service.to_dict()
+            serv['service_name'] = get_device_service_name_by_id(service.service_id)
+            services.append(serv)
+        obj['services'] = services
         del obj['service_count']
-        return json.dumps(obj,indent=2)    
+        return obj
         
 class ResponsePocket(taiseia101.CommonResponsePocket):
     
-    def __init__(self,data):
-        super(ResponsePocket,self).__init__(data)
-        self.service_name = get_device_service_name_by_id(self.service_id)
+    __slots__ = ()
     
-    def __str__(self):
-        obj = json.loads(taiseia101.CommonResponsePocket.__str__(self))
+    @property
+    def service_name(self):
+        return get_device_service_name_by_id(self.service_id)
+    
+    def to_dict(self):
+        obj = super(ResponsePocket,self).to_dict()
         obj['service_name'] = self.service_name
-        return json.dumps(obj,indent=2)    
+        return obj
+
+class ServicesStatusPocket(taiseia101.ServicesStatusResponsePocket):
+    
+    __slots__ = ()
+    
+    def to_dict(self):
+        obj = taiseia101.ServicesStatusResponsePocket.to_dict(self)
+        obj['values'] = dict((get_device_service_name_by_id(service.service_id) or 
+                              str(service.service_id), service.value)
+                             for service in self.services)
+        return obj
 
 class ServicePower:
     ON  = 1
@@ -126,6 +139,54 @@ class ServiceSAAControlSound:
     ON  = 0
     OFF = 1
 
+# default background poll interval in seconds, telemetry fast, settings slow
+poll_intervals = {
+    _srv_PowerControl: 30,
+    _srv_OpModeConfig: 60,
+    _srv_OpTimeHrConfig: 60,
+    _srv_DehumiditiferLevelConfig: 60,
+    _srv_FanLevelConfig: 60,
+    _srv_IndoorTempDisplay: 15,
+    _srv_IndoorHumidityDisplay: 5,
+    _srv_WaterFullDisplay: 5,
+    _srv_ErrTextDisplay: 30,
+    _srv_OpCurrent: 10,
+    _srv_OpVoltage: 30,
+    _srv_OpWattFactor: 30,
+    _srv_RealTimeWatt: 2,
+    _srv_TotalWatt: 60,
+    }
+
+# settings written as an absolute value, a repeated write changes nothing
+repeatable_writes = [
+    _srv_PowerControl,
+    _srv_OpModeConfig,
+    _srv_RelativeHumidityConfig,
+    _srv_DehumiditiferLevelConfig,
+    _srv_DryLevelConfig,
+    _srv_AutoSwingOnOff,
+    _srv_SwingLevelConfig,
+    _srv_LightSecenConfig,
+    _srv_AirCleanModeConfig,
+    _srv_FanLevelConfig,
+    _srv_SideFan,
+    _srv_SoundConfig,
+    _srv_Mildew,
+    _srv_HumidityHighValueConfig,
+    _srv_DashboardLock,
+    ]
+
+# power and climate readings worth a history
+history_services = [
+    _srv_OpCurrent,
+    _srv_OpVoltage,
+    _srv_OpWattFactor,
+    _srv_RealTimeWatt,
+    _srv_TotalWatt,
+    _srv_IndoorHumidityDisplay,
+    _srv_IndoorTempDisplay,
+    ]
+
 def service_read(service_id):
     packet = taiseia101.DeviceStatusReadPocket(
         type_id = taiseia101._type_Dehumiditifer,
@@ -134,6 +195,9 @@ def service_read(service_id):
         )
     return packet
     
+def services_status_read():
+    return taiseia101.ServicesStatusRequestPocket()
+
 def service_write(service_id,value):
     packet = taiseia101.DeviceStatusWritePocket(
         type_id=taiseia101._type_Dehumiditifer,
@@ -142,10 +206,25 @@ def service_write(service_id,value):
         )
     return packet
 
+def command_registry():
+    registry = command.CommandRegistry(taiseia101._type_Dehumiditifer)
+    registry.register('power', _srv_PowerControl)
+    registry.register('poweron', _srv_PowerControl, ServicePower.ON)
+    registry.register('poweroff', _srv_PowerControl, ServicePower.OFF)
+    registry.register('opmode', _srv_OpModeConfig)
+    registry.register('fanlevel', _srv_FanLevelConfig)
+    registry.register('swinglevel', _srv_SwingLevelConfig)
+    registry.register('timehr', _srv_OpTimeHrConfig)
+    registry.register('dehumidify', _srv_DehumiditiferLevelConfig)
+    registry.register('airclean', _srv_AirCleanModeConfig)
+    registry.register('sound', _srv_SAAControlSound)
+    registry.register_services()
+    return registry
+
 def parse_response_pocket(hex_data):
 
     try:
-        data = [int(x,16) for x in hex_data.split(',')]
+        data = bytearray(int(x,16) for x in hex_data.split(','))
     except ValueError:
         logging.error('CommonResponsePocket init hex_data (%s) format error\n' % hex_data)
         return None
@@ -157,7 +236,29 @@ def parse_response_pocket(hex_data):
     type_id = data[1]
     logging.debug('parse_response_pocket type_id: %s' % type_id)
     
-    if type_id == taiseia101._type_Register:
+    if taiseia101.is_services_status_frame(data):
+        pocket = ServicesStatusPocket(data)
+    elif type_id == taiseia101._type_Register:
+        pocket = RegisterPocket(data)
+    else:
+        pocket = ResponsePocket(data)
+    
+    return pocket
+
+def parse_response_bytes(data):
+
+    data = taiseia101.frame_bytes(data)
+    if len(data) < 3 or len(data) != data[0]:
+        logging.error('CommonResponsePocket init frame (%s) length error\n' % 
+                      ','.join('{:02x}'.format(x) for x in data))
+        return None
+    
+    type_id = data[1]
+    logging.debug('parse_response_bytes type_id: %s' % type_id)
+    
+    if taiseia101.is_services_status_frame(data):
+        pocket = ServicesStatusPocket(data)
+    elif type_id == taiseia101._type_Register:
         pocket = RegisterPocket(data)
     else:
         pocket = ResponsePocket(data)
@@ -0,0 +1,347 @@
+import errno
+import fcntl
+import logging
+import os
+import random
+import tty
+import serial
+import serial.threaded
+import taiseia101
+import dehumiditifer
+import framing
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+# value in a reply for a service the appliance does not have, or will not write
+NOT_SUPPORTED = 0xffff
+
+def _frame(body):
+    frame = bytearray([len(body) + 2]) + bytearray(body) + bytearray(1)
+    frame[-1] = taiseia101.calc_check_sum(frame[:-1])
+    return frame
+
+class Appliance(object):
+    """SA side state of one emulated appliance
+
+    services is {service_id: [value, writable]}. handle(frame) returns the
+    reply frame for a request frame, None when there is nothing to say.
+    drift is {service_id: (step, low, high)}: every read moves the value
+    by a random step within [low, high], so measured values change like a
+    real room's.
+    """
+
+    def __init__(self, type_id, services, brand='Emulator', model='SA-EMU',
+                 protocol=(3, 0), class_id=taiseia101._cls_HomeAppliances,
+                 drift=None, seed=None):
+        self.type_id = type_id
+        self.services = services
+        self.brand = brand
+        self.model = model
+        self.protocol = protocol
+        self.class_id = class_id
+        self.drift = drift or {}
+        self.random = random.Random(seed)
+        self.reads = 0
+        self.writes = 0
+
+    def service_pdus(self):
+        pdus = bytearray()
+        for service_id in sorted(self.services):
+            value, writable = self.services[service_id]
+            pdus += bytearray([(0x80 if writable else 0) | service_id,
+                               (value >> 8) & 0xff, value & 0xff])
+        return pdus
+
+    def register_frame(self):
+        body = bytearray([taiseia101._type_Register, self.class_id,
+                          self.protocol[0], self.protocol[1], 0,
+                          (self.type_id >> 8) & 0xff, self.type_id & 0xff])
+        body += bytearray(self.brand.encode('utf-8')) + bytearray(1)
+        body += bytearray(self.model.encode('utf-8')) + bytearray(1)
+        body += self.service_pdus()
+        return _frame(body)
+
+    def info_frame(self, service_id):
+        head = [taiseia101._type_Register, service_id]
+        if service_id == taiseia101._srv_Register:
+            return self.register_frame()
+        if service_id == taiseia101._srv_ReadDeviceClassID:
+            return _frame(head + [0, self.class_id])
+        if service_id == taiseia101._srv_ReadDeviceProtocolVer:
+            return _frame(head + list(self.protocol))
+        if service_id == taiseia101._srv_ReadDeviceTypeID:
+            return _frame(head + [(self.type_id >> 8) & 0xff, self.type_id & 0xff])
+        if service_id == taiseia101._srv_ReadDeviceBrand:
+            return _frame(bytearray(head) + bytearray(self.brand.encode('utf-8')) + bytearray(1))
+        if service_id == taiseia101._srv_ReadDeviceModel:
+            return _frame(bytearray(head) + bytearray(self.model.encode('utf-8')) + bytearray(1))
+        if service_id in (taiseia101._srv_ReadDeviceServices,
+                          taiseia101._srv_ReadDeviceServicesStatus):
+            for sid in self.drift:
+                self._drift(sid)
+            return _frame(bytearray(head) + self.service_pdus())
+        return _frame(head + [0xff, 0xff])
+
+    def _drift(self, service_id):
+        entry = self.services.get(service_id)
+        if entry is None:
+            return
+        step, low, high = self.drift[service_id]
+        entry[0] = max(low, min(high, entry[0] + self.random.randint(-step, step)))
+
+    def handle(self, frame):
+        type_id = frame[1]
+        is_read = not (frame[2] & 0x80)
+        service_id = frame[2] & 0x7f
+        if type_id == taiseia101._type_Register:
+            return self.info_frame(service_id)
+        if type_id != self.type_id:
+            return None
+        entry = self.services.get(service_id)
+        if is_read:
+            self.reads += 1
+            if service_id in self.drift:
+                self._drift(service_id)
+            value = NOT_SUPPORTED if entry is None else entry[0]
+        else:
+            self.writes += 1
+            if entry is None or not entry[1]:
+                value = NOT_SUPPORTED
+            else:
+                entry[0] = frame[3] * 0x100 + frame[4]
+                value = entry[0]
+        return _frame([type_id, frame[2], (value >> 8) & 0xff, value & 0xff])
+
+class Faults(object):
+    """error injection, each rate is a probability per reply
+
+    drop          no reply at all
+    bad_check_sum the reply check sum is flipped
+    garbage       1-8 random bytes go out before the reply
+    truncate      only the first half of the reply goes out
+    stall         the reply is held back stall_time extra seconds
+    """
+
+    def __init__(self, drop=0.0, bad_check_sum=0.0, garbage=0.0, truncate=0.0,
+                 stall=0.0, stall_time=1.0, seed=None):
+        self.drop = drop
+        self.bad_check_sum = bad_check_sum
+        self.garbage = garbage
+        self.truncate = truncate
+        self.stall = stall
+        self.stall_time = stall_time
+        self.random = random.Random(seed)
+        self.injected = 0
+
+    def apply(self, reply):
+        """(bytes to send or None, extra delay)"""
+        rnd = self.random.random
+        if rnd() < self.drop:
+            self.injected += 1
+            return None, 0.0
+        reply = bytearray(reply)
+        if rnd() < self.bad_check_sum:
+            self.injected += 1
+            reply[-1] ^= 0xff
+        if rnd() < self.truncate:
+            self.injected += 1
+            reply = reply[:len(reply) // 2]
+        if rnd() < self.garbage:
+            self.injected += 1
+            reply = bytearray(self.random.randint(0, 0xff)
+                              for _ in range(self.random.randint(1, 8))) + reply
+        delay = 0.0
+        if rnd() < self.stall:
+            self.injected += 1
+            delay = self.stall_time
+        return reply, delay
+
+# measured values and settings the appliance does not let a client change
+_dehumidifier_read_only = set([
+    dehumiditifer._srv_IndoorTempDisplay,
+    dehumiditifer._srv_IndoorHumidityDisplay,
+    dehumiditifer._srv_WaterFullDisplay,
+    dehumiditifer._srv_CleanNotify,
+    dehumiditifer._srv_DefrostingDisplay,
+    dehumiditifer._srv_ErrTextDisplay,
+    dehumiditifer._srv_HumidityHighNotify,
+    dehumiditifer._srv_OpCurrent,
+    dehumiditifer._srv_OpVoltage,
+    dehumiditifer._srv_OpWattFactor,
+    dehumiditifer._srv_RealTimeWatt,
+    dehumiditifer._srv_TotalWatt,
+    ])
+
+_dehumidifier_values = {
+    dehumiditifer._srv_PowerControl: dehumiditifer.ServicePower.OFF,
+    dehumiditifer._srv_RelativeHumidityConfig: 55,
+    dehumiditifer._srv_IndoorTempDisplay: 26,
+    dehumiditifer._srv_IndoorHumidityDisplay: 60,
+    dehumiditifer._srv_OpVoltage: 110,
+    dehumiditifer._srv_RealTimeWatt: 250,
+    dehumiditifer._srv_TotalWatt: 1200,
+    }
+
+_dehumidifier_drift = {
+    dehumiditifer._srv_IndoorTempDisplay: (1, 18, 35),
+    dehumiditifer._srv_IndoorHumidityDisplay: (1, 30, 90),
+    dehumiditifer._srv_RealTimeWatt: (15, 0, 600),
+    }
+
+def dehumidifier(services=None, values=None, brand='Panasonic', model='FY24CXW-EMU', seed=None):
+    """Appliance with the dehumiditifer service table
+
+    services: service names or ids to report at register, default all
+    but the reserved ones; values: {name or id: value} start values.
+    """
+    type_id = taiseia101._type_Dehumiditifer
+    table = taiseia101.registry.services(type_id)
+    if services is None:
+        service_ids = [sid for name, sid in table.items()
+                       if sid not in (dehumiditifer._srv_Reserved, dehumiditifer._srv_EngMode)]
+    else:
+        service_ids = [table[s] if s in table else int(s) for s in services]
+    start = dict(_dehumidifier_values)
+    for key, value in (values or {}).items():
+        start[table[key] if key in table else int(key)] = int(value)
+    entries = {}
+    for sid in service_ids:
+        entries[sid] = [start.get(sid, 0), sid not in _dehumidifier_read_only]
+    drift = dict((sid, d) for sid, d in _dehumidifier_drift.items() if sid in entries)
+    return Appliance(type_id, entries, brand=brand, model=model, drift=drift, seed=seed)
+
+class _ApplianceMixin(object):
+    """one appliance answering on a serial line, driven by an event loop
+
+    Replies leave delay seconds after the request plus the wire time of
+    the reply at baudrate, one at a time as on a real half duplex bus.
+    The port class feeds received() and provides write(data).
+    """
+
+    def __init__(self, loop, device_id, appliance, faults=None, delay=0.05, baudrate=9600):
+        self.loop = loop
+        self.device_id = device_id
+        self.appliance = appliance
+        self.faults = faults or Faults()
+        self.delay = delay
+        self.baudrate = baudrate
+        self.decoder = framing.FrameDecoder()
+        self.busy_until = 0.0
+        self.requests = 0
+        self.replies = 0
+
+    def received(self, data):
+        for frame in self.decoder.feed(data):
+            self.requests += 1
+            reply = self.appliance.handle(frame)
+            if reply is None:
+                continue
+            reply, extra = self.faults.apply(reply)
+            if reply is None:
+                continue
+            now = self.loop.time()
+            wire_time = len(reply) * 10.0 / self.baudrate
+            when = max(now + self.delay, self.busy_until) + extra + wire_time
+            self.busy_until = when
+            self.loop.call_at(when, self._send, reply)
+
+    def _send(self, reply):
+        self.replies += 1
+        self.write(bytes(reply))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'replies': self.replies,
+            'faults': self.faults.injected,
+            'reads': self.appliance.reads,
+            'writes': self.appliance.writes,
+            }
+
+class PtyPort(_ApplianceMixin):
+    """emulated appliance behind a new pseudo terminal, the gateway opens path()"""
+
+    def __init__(self, loop, device_id, appliance, **kwargs):
+        super(PtyPort, self).__init__(loop, device_id, appliance, **kwargs)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.link = None
+
+    def path(self):
+        return self.link or os.ttyname(self.slave)
+
+    def start(self, link=None):
+        if link is not None:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(os.ttyname(self.slave), link)
+            self.link = link
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.loop.add_reader(self.master, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if data:
+            self.received(data)
+
+    def write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            logging.warning('%s pty full, reply dropped' % self.device_id)
+
+    def stop(self):
+        self.loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+
+class _SerialBridge(serial.threaded.Protocol):
+
+    def __init__(self, port):
+        self.port = port
+
+    def __call__(self):
+        return self
+
+    def data_received(self, data):
+        self.port.loop.call_soon_threadsafe(self.port.received, data)
+
+class SerialUrlPort(_ApplianceMixin):
+    """emulated appliance on a pyserial URL, e.g. a real port or socket://"""
+
+    def __init__(self, loop, device_id, appliance, url, **kwargs):
+        super(SerialUrlPort, self).__init__(loop, device_id, appliance, **kwargs)
+        self.url = url
+        self.ser = None
+        self.reader = None
+
+    def path(self):
+        return self.url
+
+    def start(self, link=None):
+        self.ser = serial.serial_for_url(self.url, baudrate=self.baudrate)
+        self.reader = serial.threaded.ReaderThread(self.ser, _SerialBridge(self))
+        self.reader.start()
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def stop(self):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
@@ -0,0 +1,284 @@
+import time
+import heapq
+import socket
+import select
+import logging
+import os
+import collections
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+EVENT_READ = 0x01
+EVENT_WRITE = 0x02
+
+class TimeoutError(Exception):
+    pass
+
+class CancelledError(Exception):
+    pass
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.masks = {}
+
+    def update(self, fd, mask):
+        events = 0
+        if mask & EVENT_READ:
+            events |= select.EPOLLIN
+        if mask & EVENT_WRITE:
+            events |= select.EPOLLOUT
+        if fd in self.masks:
+            if mask:
+                self.epoll.modify(fd, events)
+            else:
+                self.epoll.unregister(fd)
+                del self.masks[fd]
+                return
+        elif mask:
+            self.epoll.register(fd, events)
+        else:
+            return
+        self.masks[fd] = mask
+
+    def poll(self, timeout):
+        result = []
+        for fd, events in self.epoll.poll(-1 if timeout is None else timeout):
+            mask = 0
+            if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                mask |= EVENT_READ
+            if events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                mask |= EVENT_WRITE
+            result.append((fd, mask & self.masks.get(fd, 0)))
+        return result
+
+    def close(self):
+        self.epoll.close()
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self.masks = {}
+
+    def update(self, fd, mask):
+        if mask:
+            self.masks[fd] = mask
+        else:
+            self.masks.pop(fd, None)
+
+    def poll(self, timeout):
+        readers = [fd for fd, mask in self.masks.items() if mask & EVENT_READ]
+        writers = [fd for fd, mask in self.masks.items() if mask & EVENT_WRITE]
+        r, w, _ = select.select(readers, writers, [], timeout)
+        events = collections.defaultdict(int)
+        for fd in r:
+            events[fd] |= EVENT_READ
+        for fd in w:
+            events[fd] |= EVENT_WRITE
+        return events.items()
+
+    def close(self):
+        pass
+
+class TimerHandle(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class Future(object):
+    """result placeholder resolved on the event loop thread"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def result(self):
+        if not self._done:
+            raise ValueError('Future result is not ready')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        if self._done:
+            self.loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        if self._done:
+            return
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        if self._done:
+            return
+        self._exception = exception
+        self._finish()
+
+    def cancel(self):
+        self.set_exception(CancelledError())
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self.loop.call_soon(callback, self)
+
+class EventLoop(object):
+    """single thread select/epoll loop with timers and a thread safe wakeup"""
+
+    def __init__(self):
+        self._poller = _EpollPoller() if hasattr(select, 'epoll') else _SelectPoller()
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._ready = collections.deque()
+        self._threadsafe = collections.deque()
+        self._running = False
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.add_reader(self._wakeup_r.fileno(), self._drain_wakeup)
+
+    def time(self):
+        return time.time()
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self._readers:
+            mask |= EVENT_READ
+        if fd in self._writers:
+            mask |= EVENT_WRITE
+        self._poller.update(fd, mask)
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._threadsafe.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\x00')
+        except socket.error:
+            # wakeup pipe full, the loop is going to wake anyway
+            pass
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        timer = TimerHandle(when, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def create_future(self):
+        return Future(self)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('EventLoop callback %r error' % callback)
+
+    def stop(self):
+        self._running = False
+
+    def is_running(self):
+        return self._running
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def run_once(self):
+        while self._threadsafe:
+            self._ready.append(self._threadsafe.popleft())
+
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0].when - self.time())
+
+        try:
+            events = self._poller.poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            if e.args and e.args[0] == 4: # EINTR
+                events = []
+            else:
+                raise
+        for fd, mask in events:
+            # handlers may remove each other, so look them up at dispatch
+            if mask & EVENT_READ and fd in self._readers:
+                self._run(*self._readers[fd])
+            if mask & EVENT_WRITE and fd in self._writers:
+                self._run(*self._writers[fd])
+
+        now = self.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            self._run(callback, args)
+
+    def close(self):
+        self.remove_reader(self._wakeup_r.fileno())
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self._poller.close()
@@ -0,0 +1,73 @@
+import collections
+import threading
+
+POLICY_DISCONNECT = 'disconnect'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_SAMPLE = 'sample'
+POLICIES = (POLICY_DISCONNECT, POLICY_DROP_OLDEST, POLICY_SAMPLE)
+
+class SendQueue(object):
+    """bounded queue of serialized messages waiting to go to one client
+
+    Messages are shared between all clients, a queue only keeps references.
+    When the client falls behind, the policy decides:
+      disconnect   a full queue means the client is dropped (put() -> False)
+      drop-oldest  a full queue discards its oldest message
+      sample       above half full only every sample_every-th message is
+                   queued, a full queue discards its oldest message
+    """
+
+    def __init__(self, max_messages=256, policy=POLICY_DISCONNECT, sample_every=4):
+        if policy not in POLICIES:
+            raise ValueError('unknown slow client policy: %s' % policy)
+        self.max_messages = max_messages
+        self.policy = policy
+        self.sample_every = sample_every
+        self.messages = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.skipped = 0
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message):
+        """queue message, False if the client should be disconnected"""
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.messages) >= self.max_messages:
+                if self.policy == POLICY_DISCONNECT:
+                    return False
+                self.messages.popleft()
+                self.dropped += 1
+            elif self.policy == POLICY_SAMPLE and len(self.messages) * 2 >= self.max_messages:
+                self.skipped += 1
+                if self.skipped % self.sample_every:
+                    self.dropped += 1
+                    return True
+            self.messages.append(message)
+            self.cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """oldest message, blocking up to timeout seconds, None if there is none"""
+        with self.cond:
+            if not self.messages and not self.closed:
+                self.cond.wait(timeout)
+            if self.messages:
+                return self.messages.popleft()
+            return None
+
+    def get_nowait(self):
+        with self.cond:
+            if self.messages:
+                return self.messages.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.messages.clear()
+            self.cond.notify_all()
@@ -0,0 +1,119 @@
+import time
+import logging
+import os
+import taiseia101
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+FRAME_MIN_LENGTH = 6
+FRAME_MAX_LENGTH = 0xff
+
+class FrameDecoder(object):
+    """serial byte stream -> validated TaiSEIA 101 frames
+    
+    Bytes are kept in a fixed size ring buffer. A frame is the length byte
+    followed by length-1 bytes whose XOR (length byte included) is zero.
+    On a bad length byte, a bad check sum or a partial frame that stalls
+    longer than frame_timeout, the head byte is dropped and decoding
+    resyncs on the next byte.
+    """
+    
+    def __init__(self, capacity=512, min_length=FRAME_MIN_LENGTH,
+                 max_length=FRAME_MAX_LENGTH, frame_timeout=0.5):
+        if capacity < max_length:
+            raise ValueError('FrameDecoder capacity %s < max frame length %s' % 
+                             (capacity, max_length))
+        self.capacity = capacity
+        self.min_length = min_length
+        self.max_length = max_length
+        self.frame_timeout = frame_timeout
+        self.ring = bytearray(capacity)
+        self.head = 0
+        self.count = 0
+        self.last_feed_time = None
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.bad_length = 0
+        self.bad_check_sum = 0
+        
+    def reset(self):
+        self.dropped_bytes += self.count
+        self.head = 0
+        self.count = 0
+        
+    def pending(self):
+        return self.count
+        
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'dropped_bytes': self.dropped_bytes,
+            'bad_length': self.bad_length,
+            'bad_check_sum': self.bad_check_sum,
+            'pending': self.count
+            }
+    
+    def feed(self, data, now=None):
+        """append a chunk, yield each complete frame as a bytearray"""
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if now is None:
+            now = time.time()
+        if (self.count > 0 and self.frame_timeout is not None and 
+                self.last_feed_time is not None and 
+                now - self.last_feed_time > self.frame_timeout):
+            # the partial frame never completed, it can not be trusted
+            logging.warning('FrameDecoder partial frame timeout, resync')
+            self._drop(1)
+        self.last_feed_time = now
+        
+        offset = 0
+        while offset < len(data):
+            n = min(self.capacity - self.count, len(data) - offset)
+            self._write(data, offset, n)
+            offset += n
+            for frame in self._decode():
+                yield frame
+    
+    def _write(self, data, offset, n):
+        tail = (self.head + self.count) % self.capacity
+        first = min(n, self.capacity - tail)
+        self.ring[tail:tail+first] = data[offset:offset+first]
+        if first < n:
+            self.ring[0:n-first] = data[offset+first:offset+n]
+        self.count += n
+    
+    def _drop(self, n):
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
+        self.dropped_bytes += n
+    
+    def _read(self, n):
+        end = self.head + n
+        if end <= self.capacity:
+            return self.ring[self.head:end]
+        return self.ring[self.head:] + self.ring[:end - self.capacity]
+    
+    def _decode(self):
+        while self.count > 0:
+            length = self.ring[self.head]
+            if length < self.min_length or length > self.max_length:
+                self.bad_length += 1
+                self._drop(1)
+                continue
+            if self.count < length:
+                break
+            frame = self._read(length)
+            if taiseia101.calc_check_sum(frame) != 0:
+                logging.debug('FrameDecoder check sum error, resync')
+                self.bad_check_sum += 1
+                self._drop(1)
+                continue
+            self.head = (self.head + length) % self.capacity
+            self.count -= length
+            self.frames += 1
+            yield frame
@@ -0,0 +1,735 @@
+import socket
+import errno
+import logging
+import os
+import serial.threaded
+import taiseia101
+import framing
+import transaction
+import shadow
+import scheduler
+import fanout
+import wire
+import metrics
+import cmdqueue
+import subscription
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+class SerialBridge(serial.threaded.Protocol):
+    """serial reader thread -> device event loop"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.device.loop.call_soon_threadsafe(self.device.serial_connected)
+
+    def data_received(self, data):
+        self.device.loop.call_soon_threadsafe(self.device.serial_received, data)
+
+    def connection_lost(self, exc):
+        self.device.loop.call_soon_threadsafe(self.device.serial_lost, exc)
+
+class ClientConnection(object):
+    """one TCP client; outgoing messages wait in a bounded fanout.SendQueue"""
+
+    def __init__(self, gateway, sock, addr):
+        self.gateway = gateway
+        self.loop = gateway.loop
+        self.sock = sock
+        self.client_ip = addr[0]
+        self.name = '%s:%s' % (addr[0], addr[1])
+        self.fd = sock.fileno()
+        self.queue = fanout.SendQueue(gateway.client_queue, gateway.slow_client_policy)
+        self.format = gateway.output_format
+        # unsent rest of the message being written
+        self.current = None
+        # start of a command line the next recv completes
+        self.in_buff = b''
+        self.closed = False
+
+    def start(self):
+        sock = self.sock
+        sock.setblocking(False)
+        # More quickly detect bad clients who quit without closing the
+        # connection, same keep-alive settings as the threaded server.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            logging.error('sck client(%s) ERROR: %s' % (self.client_ip, e))
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        logging.info('sck client(%s) data: %s' % (self.client_ip, data))
+        lines = (self.in_buff + data).split(b'\n')
+        self.in_buff = lines.pop()
+        for line in lines:
+            cmd = line.strip()
+            if not cmd:
+                continue
+            if cmd[:4] == 'exit':
+                self.close()
+                return
+            self.gateway.submit(cmd, self)
+
+    def send(self, data):
+        """queue data, the caller may share the same data with other clients"""
+        if self.closed:
+            return
+        if not self.queue.put(data):
+            logging.warning('sck client(%s) too slow, %s messages queued, disconnect' % 
+                            (self.client_ip, len(self.queue)))
+            self.close()
+            return
+        if self.current is None:
+            self._on_writable()
+
+    def _on_writable(self):
+        while True:
+            if self.current is None:
+                data = self.queue.get_nowait()
+                if data is None:
+                    self.loop.remove_writer(self.fd)
+                    return
+                self.current = memoryview(data)
+            try:
+                n = self.sock.send(self.current)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    n = 0
+                else:
+                    logging.error('sck client(%s) ERROR: %s' % (self.client_ip, e))
+                    self.close()
+                    return
+            if n < len(self.current):
+                self.current = self.current[n:]
+                self.loop.add_writer(self.fd, self._on_writable)
+                return
+            self.current = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        self.current = None
+        logging.info('sck client(%s) Disconnected' % self.client_ip)
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.sock.close()
+        self.gateway.client_closed(self)
+
+class SerialDevice(object):
+    """one appliance on one serial port, driven by an event loop
+
+    compile_command(cmd) turns a command line into the bytes to write on
+    the serial port (empty for none), parse_frame(frame) turns a decoded
+    serial frame into a response pocket. submit() returns a future of the
+    pocket answering the command. Every decoded pocket is also reported
+    to listener.device_frame(device, pocket, solicited).
+
+    With shadow_ttl > 0, reads are answered from the device shadow while
+    its value is younger than shadow_ttl seconds, and values clients keep
+    reading are refreshed in the background before they expire.
+
+    With a regcache.RegistrationCache, the register response cached for
+    the serial port answers 'register' right from start. The first
+    command sent afterwards triggers a protocol version and model read;
+    if they differ from the cached identity the entry is dropped.
+
+    With a metrics.Metrics, response latency, timeouts, decoder counters
+    and the number of requests queued or in flight are reported per device.
+
+    With a historian.Historian, every value read is recorded there; with
+    a statetable.StateTable, the latest values are published there for
+    local readers.
+
+    Requests wait in a cmdqueue.CommandQueue until fewer than
+    max_in_flight are unanswered on the line. Client commands take the
+    interactive lane, polling and shadow refresh the background lane;
+    writes to one service and identical reads merge while they wait, or
+    join the read already on the line.
+
+    The response timeout adapts to the measured response time of the
+    device (request_timeout is the upper bound, a client timeout
+    overrides it). A read without a response goes out again up to
+    retries times, a write only if its (type_id, service_id) is in
+    repeatable_writes.
+    """
+
+    def __init__(self, loop, device_id, ser, compile_command, parse_frame,
+                 request_timeout=2.0, shadow_ttl=0, registration_cache=None,
+                 metrics=None, max_in_flight=1, starvation_limit=4, historian=None,
+                 retries=0, repeatable_writes=(), state_table=None):
+        self.loop = loop
+        self.device_id = device_id
+        self.ser = ser
+        self.compile_command = compile_command
+        self.parse_frame = parse_frame
+        self.listener = None
+        self.decoder = framing.FrameDecoder()
+        self.rtt = transaction.RttEstimator(max_timeout=request_timeout)
+        self.transactions = transaction.TransactionTable(loop, request_timeout, self.rtt, 
+                                                         retries, self._retransmit)
+        self.repeatable_writes = repeatable_writes
+        self.queue = cmdqueue.CommandQueue(starvation_limit)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.shadow = shadow.DeviceShadow(shadow_ttl) if shadow_ttl > 0 else None
+        self.refresh_timer = None
+        self.poller = None
+        self.device_type_id = None
+        self.registration_cache = registration_cache
+        self.registration = None
+        # None: not checked yet, False: check in flight, True: matches the device
+        self.registration_verified = None
+        self.metrics = metrics
+        self.historian = historian
+        self.state_table = state_table
+        if metrics is not None:
+            self.transactions.on_timeout = self._timeout_metric
+        self.connected = False
+        self.serial_worker = None
+
+    def start(self):
+        if self.registration_cache is not None:
+            self._load_registration()
+        if self.metrics is not None:
+            self.metrics.add_collector(self._metric_samples)
+        self.serial_worker = serial.threaded.ReaderThread(self.ser, SerialBridge(self))
+        self.serial_worker.start()
+        if self.shadow is not None:
+            self.refresh_timer = self.loop.call_later(self.shadow.ttl / 4.0, self._refresh_shadow)
+        if self.poller is not None:
+            self.poller.start()
+
+    def stop(self):
+        if self.metrics is not None:
+            self.metrics.remove_collector(self._metric_samples)
+        if self.poller is not None:
+            self.poller.stop()
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+            self.refresh_timer = None
+        self._cancel_queued()
+        self.transactions.cancel_all()
+        if self.serial_worker is not None:
+            self.serial_worker.stop()
+            self.serial_worker = None
+        if self.historian is not None:
+            self.historian.close()
+        if self.state_table is not None:
+            self.state_table.close()
+
+    def submit(self, cmd, timeout=None):
+        """write cmd to the serial port, return a future of its response pocket
+
+        The future fails with ValueError when cmd does not compile, e.g.
+        an unknown name or a value out of range.
+        """
+        logging.debug('%s recv cmd: %s' % (self.device_id, cmd))
+        data = self.compile_command(cmd)
+        if len(data) == 0:
+            logging.debug('no data for serial port')
+            future = self.loop.create_future()
+            future.set_exception(ValueError('invalid command'))
+            return future
+        if self.registration is not None and self.registration_verified is None:
+            self._verify_registration()
+        return self.submit_frame(data, timeout)
+
+    def submit_frame(self, data, timeout=None, use_shadow=True, lane=cmdqueue.INTERACTIVE):
+        key = transaction.request_key(data)
+        if key is None:
+            logging.debug('%s send bytes command %s' % (self.device_id, taiseia101.frame_hex(data)))
+            self.ser.write(data)
+            return None
+
+        if (use_shadow and self.registration is not None and 
+                key[0] == taiseia101._type_Register and 
+                bytearray(data[2:3])[0] == taiseia101._srv_Register):
+            logging.debug('register answered from cache')
+            future = self.loop.create_future()
+            future.set_result(self.registration)
+            return future
+
+        if self.shadow is not None and key[0] != taiseia101._type_Register:
+            type_id, service_id, is_read = key
+            if is_read and use_shadow:
+                future = self._read_shadow(type_id, service_id)
+                if future is not None:
+                    return future
+            elif not is_read:
+                head = bytearray(data[3:5])
+                self.shadow.update(type_id, service_id, head[0] * 0x100 + head[1], 
+                                   now=self.loop.time(), optimistic=True)
+
+        future = self.loop.create_future()
+        if self.shadow is not None and not key[2]:
+            future.add_done_callback(lambda f, key=key: self._write_done(key, f))
+        self.queue.put(data, lane, (future, timeout))
+        self._pump()
+        return future
+
+    def _pump(self):
+        while self.in_flight < self.max_in_flight:
+            cmd = self.queue.get_nowait()
+            if cmd is None:
+                return
+            self._send(cmd)
+
+    def _send(self, cmd):
+        timeouts = [timeout for future, timeout in cmd.waiters if timeout is not None]
+        tr = self.transactions.submit(transaction.request_key(cmd.data), cmd.data, 
+                                      timeout=min(timeouts) if timeouts else None,
+                                      retry=transaction.repeatable(cmd.data, self.repeatable_writes))
+        self.in_flight += 1
+        tr.future.add_done_callback(lambda f, cmd=cmd: self._answered(cmd, f))
+        self.queue.sent(cmd)
+        if cmd.merged:
+            logging.debug('%s requests merged into one' % (cmd.merged + 1))
+        logging.debug('%s send bytes command %s' % (self.device_id, taiseia101.frame_hex(cmd.data)))
+        self.ser.write(cmd.data)
+
+    def _retransmit(self, tr):
+        if self.metrics is not None:
+            self.metrics.inc('taiseia_request_retransmits_total', 
+                             metrics.service_labels(self.device_id, tr.key))
+        logging.debug('%s send bytes command %s' % (self.device_id, taiseia101.frame_hex(tr.data)))
+        self.ser.write(tr.data)
+
+    def _answered(self, cmd, f):
+        self.in_flight -= 1
+        self.queue.finished(cmd.key)
+        for future, timeout in cmd.waiters:
+            if future.done():
+                continue
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                future.set_result(f.result())
+        self._pump()
+
+    def _cancel_queued(self):
+        for cmd in self.queue.clear():
+            for future, timeout in cmd.waiters:
+                future.cancel()
+
+    def _read_shadow(self, type_id, service_id):
+        entry = self.shadow.get(type_id, service_id, self.loop.time())
+        if entry is None:
+            return None
+        if entry.pocket is None:
+            # optimistic write or bulk status value, answer with a response
+            # frame built here, not through the request frame cache
+            frame = bytearray([6, type_id, service_id & 0x7f,
+                               (entry.value & 0xff00) >> 8, entry.value & 0x00ff, 0])
+            frame[-1] = taiseia101.calc_check_sum(frame[:-1])
+            entry.pocket = self.parse_frame(frame)
+            entry.pocket.timestamp = entry.timestamp
+        logging.debug('shadow hit %s' % ((type_id, service_id),))
+        future = self.loop.create_future()
+        future.set_result(entry.pocket)
+        return future
+
+    def _load_registration(self):
+        cached = self.registration_cache.get(self.ser.port)
+        if cached is None:
+            return
+        try:
+            pocket = self.parse_frame(cached[0])
+        except Exception as e:
+            logging.warning('%s cached registration unusable: %s' % (self.device_id, e))
+            self.registration_cache.invalidate(self.ser.port)
+            return
+        if not isinstance(pocket, taiseia101.RegisterResponsePocket):
+            return
+        logging.info('%s cached registration: %s %s' % (self.device_id, pocket.brand, pocket.model))
+        self.registration = pocket
+        self.registration_verified = None
+        self.device_type_id = pocket.type_id
+
+    def _verify_registration(self):
+        self.registration_verified = False
+        protocol = self.submit_frame(
+            taiseia101.encode_request(taiseia101._type_Register, True, 
+                                      taiseia101._srv_ReadDeviceProtocolVer))
+        model = self.submit_frame(
+            taiseia101.encode_request(taiseia101._type_Register, True, 
+                                      taiseia101._srv_ReadDeviceModel))
+        # type 0 replies come back in order, the model read finishes last
+        model.add_done_callback(lambda f: self._registration_checked(protocol, model))
+
+    def _registration_checked(self, protocol, model):
+        if self.registration is None or model.cancelled() or protocol.cancelled():
+            return
+        if protocol.exception() is not None or model.exception() is not None:
+            logging.warning('%s registration check failed, retry on next command' % self.device_id)
+            self.registration_verified = None
+            return
+        cached = self.registration.protocol
+        if (protocol.result().protocol == cached and 
+                model.result().text == self.registration.model):
+            logging.info('%s cached registration verified' % self.device_id)
+            self.registration_verified = True
+            return
+        logging.warning('%s device is %s protocol %s, not the cached %s, drop cache' % 
+                        (self.device_id, model.result().text, protocol.result().protocol, 
+                         self.registration.model))
+        self.registration = None
+        self.registration_verified = None
+        self.registration_cache.invalidate(self.ser.port)
+
+    def _write_done(self, key, future):
+        if future.exception() is not None:
+            # the optimistic value was never confirmed
+            self.shadow.invalidate(key[0], key[1])
+
+    def _refresh_shadow(self):
+        now = self.loop.time()
+        for type_id, service_id in self.shadow.stale(self.shadow.ttl * 0.75, now):
+            if (type_id, service_id, True) in self.transactions.pending:
+                continue
+            logging.debug('shadow refresh %s' % ((type_id, service_id),))
+            self.submit_frame(taiseia101.encode_request(type_id, True, service_id), 
+                              use_shadow=False, lane=cmdqueue.BACKGROUND)
+        self.refresh_timer = self.loop.call_later(self.shadow.ttl / 4.0, self._refresh_shadow)
+
+    def serial_connected(self):
+        self.connected = True
+        logging.debug('serial connect made')
+
+    def serial_lost(self, exc):
+        self.connected = False
+        logging.warning('%s serial connect lost: %s' % (self.device_id, str(exc)))
+        self._cancel_queued()
+        self.transactions.cancel_all()
+        if self.listener is not None:
+            self.listener.device_lost(self, exc)
+
+    def serial_received(self, data):
+        for frame in self.decoder.feed(data):
+            data_hex = taiseia101.frame_hex(frame)
+            logging.info('%s data frame hex: %s' % (self.device_id, data_hex))
+            try:
+                pocket = self._parse(frame)
+            except Exception as e:
+                # e.g. an info reply after its transaction timed out, which
+                # then reads as a register reply; the rest of data still counts
+                logging.warning('%s frame %s not parsed: %s' % (self.device_id, data_hex, e))
+                continue
+            if pocket is None:
+                continue
+            self._learn(frame, pocket)
+            tr = self.transactions.match(frame, pocket)
+            solicited = tr is not None
+            if solicited and self.metrics is not None:
+                self.metrics.observe('taiseia_request_latency_seconds', 
+                                     self.loop.time() - tr.sent_time,
+                                     metrics.service_labels(self.device_id, tr.key))
+            if not solicited:
+                logging.debug('unsolicited frame %s' % data_hex)
+            if self.listener is not None:
+                self.listener.device_frame(self, pocket, solicited)
+
+    def _timeout_metric(self, tr):
+        self.metrics.inc('taiseia_request_timeouts_total', 
+                         metrics.service_labels(self.device_id, tr.key))
+
+    def _metric_samples(self):
+        samples = metrics.decoder_samples(self.device_id, self.decoder)
+        samples.append(('taiseia_command_queue_depth', {'device': self.device_id}, 
+                        len(self.transactions) + len(self.queue)))
+        samples.append(('taiseia_request_timeout_seconds', {'device': self.device_id}, 
+                        self.rtt.timeout()))
+        return samples
+
+    def _parse(self, frame):
+        if frame[1] == taiseia101._type_Register:
+            tr = self.transactions.peek(transaction.response_key(frame))
+            if tr is not None:
+                service_id = bytearray(tr.data[2:3])[0] & 0x7f
+                if service_id not in (taiseia101._srv_Register, 
+                                      taiseia101._srv_ReadDeviceServicesStatus):
+                    return taiseia101.DeviceInfoResponsePocket(frame)
+        return self.parse_frame(frame)
+
+    def _learn(self, frame, pocket):
+        now = self.loop.time()
+        if self.historian is not None:
+            self.historian.record_pocket(self.device_id, pocket, self.device_type_id)
+        if self.state_table is not None:
+            self.state_table.publish_pocket(self.device_id, pocket, self.device_type_id)
+        if frame[1] != taiseia101._type_Register:
+            self.device_type_id = frame[1]
+            if self.shadow is not None:
+                self.shadow.update(pocket.type_id, pocket.service_id, pocket.value, pocket, now)
+            if self.poller is not None:
+                self.poller.observe(pocket.type_id, pocket.service_id, pocket.value)
+        elif isinstance(pocket, taiseia101.ServicesStatusResponsePocket):
+            if self.device_type_id is None:
+                return
+            for service_id, value in pocket.values.items():
+                if self.shadow is not None:
+                    self.shadow.update(self.device_type_id, service_id, value, None, now)
+                if self.poller is not None:
+                    self.poller.observe(self.device_type_id, service_id, value)
+        elif isinstance(pocket, taiseia101.RegisterResponsePocket):
+            self.device_type_id = pocket.type_id
+            if self.registration_cache is not None:
+                if (self.registration is None or 
+                        bytes(self.registration.bytes) != bytes(pocket.bytes)):
+                    self.registration_cache.put(self.ser.port, pocket)
+                self.registration = pocket
+                self.registration_verified = True
+
+    def enable_polling(self, type_id, intervals, share=0.5):
+        """poll {service_id: seconds} of type_id within share of the serial bandwidth"""
+        if share <= 0:
+            raise ValueError('poll share must be greater than 0: %s' % share)
+        fps = scheduler.frame_budget(self.ser.baudrate, share)
+        logging.info('polling %s services, budget %.1f frames/s' % (len(intervals), fps))
+        self.poller = scheduler.PollScheduler(self.loop, self._poll, fps)
+        for service_id, interval in intervals.items():
+            self.poller.add(type_id, service_id, interval)
+        return self.poller
+
+    def _poll(self, type_id, service_id):
+        if (type_id, service_id, True) in self.transactions.pending:
+            return
+        self.submit_frame(taiseia101.encode_request(type_id, True, service_id), 
+                          use_shadow=False, lane=cmdqueue.BACKGROUND)
+
+    def read_services_status(self, timeout=None):
+        """one ReadDeviceServicesStatus round trip, future of the pocket with .values"""
+        return self.submit_frame(taiseia101.ServicesStatusRequestPocket().encode(), timeout)
+
+class Gateway(object):
+    """one event loop serving all TCP clients for one or more devices
+
+    A command line is sent to the only device, or in front of several
+    devices it is addressed as '@<device_id> <command>'; 'devices' lists
+    the device ids. Each response goes to the client whose command it
+    answers; frames nobody asked for are only broadcast when
+    broadcast_unsolicited is set.
+
+    Each client has a send queue of at most client_queue messages; a
+    client that lets it fill up is handled by slow_client_policy, one of
+    fanout.POLICIES.
+
+    Pockets go out in output_format, one of wire.FORMATS; a client picks
+    its own with the 'format <name>' command.
+
+    A client may also 'subscribe' to services (see
+    subscription.parse_command): every value read from them, by anyone,
+    is then pushed to it, or with 'delta on' and deadbands only the
+    changes. Subscription commands are answered in json or ndjson, so a
+    binary client subscribes first and then switches format.
+    """
+
+    def __init__(self, loop, localport=7778, host='', backlog=128,
+                 broadcast_unsolicited=False, client_queue=256,
+                 slow_client_policy=fanout.POLICY_DISCONNECT,
+                 output_format=wire.FORMAT_JSON, metrics=None):
+        self.loop = loop
+        self.localport = localport
+        self.host = host
+        self.backlog = backlog
+        self.broadcast_unsolicited = broadcast_unsolicited
+        self.client_queue = client_queue
+        self.slow_client_policy = slow_client_policy
+        self.output_format = output_format
+        self.metrics = metrics
+        self.devices = {}
+        self.clients = []
+        self.subscribers = subscription.Subscribers()
+        self.srv = None
+
+    def add_device(self, device):
+        """device: SerialDevice, or any object with its device_id/submit/start/stop"""
+        device.listener = self
+        self.devices[device.device_id] = device
+        return device
+
+    def start(self):
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((self.host, self.localport))
+        srv.listen(self.backlog)
+        srv.setblocking(False)
+        self.srv = srv
+        self.loop.add_reader(srv.fileno(), self._accept)
+        if self.metrics is not None:
+            self.metrics.add_collector(self._metric_samples)
+        for device in self.devices.values():
+            device.start()
+        logging.info('Waiting for connection on {}...'.format(self.localport))
+
+    def stop(self):
+        if self.metrics is not None:
+            self.metrics.remove_collector(self._metric_samples)
+        for device in self.devices.values():
+            device.stop()
+        for client in list(self.clients):
+            client.close()
+        if self.srv is not None:
+            self.loop.remove_reader(self.srv.fileno())
+            self.srv.close()
+            self.srv = None
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.srv.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                logging.error('sck serv accept ERROR: %s' % e)
+                return
+            logging.info('Connected by {}'.format(addr))
+            client = ClientConnection(self, sock, addr)
+            self.clients.append(client)
+            client.start()
+
+    def _metric_samples(self):
+        return metrics.client_samples([(client.name, client.queue) for client in self.clients])
+
+    def client_closed(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        self.subscribers.remove(client)
+
+    def resolve(self, cmd):
+        """command line -> (device, command), device None if not addressed"""
+        if cmd[:1] == '@':
+            parts = cmd[1:].split(None, 1)
+            if len(parts) != 2:
+                return None, cmd
+            return self.devices.get(parts[0]), parts[1]
+        if len(self.devices) == 1:
+            return list(self.devices.values())[0], cmd
+        return None, cmd
+
+    def submit(self, cmd, client=None, timeout=None):
+        """route cmd to its device, the response (or error) goes back to client"""
+        if cmd == 'devices':
+            if client is not None:
+                self.send_message(client, {'devices': sorted(self.devices.keys())})
+            return None
+        fmt = wire.parse_format_command(cmd)
+        if fmt is not None:
+            if client is not None:
+                self.set_format(client, fmt)
+            return None
+        try:
+            sub_cmd = subscription.parse_command(cmd)
+        except ValueError as e:
+            if client is not None:
+                self.subscription_error(client, cmd, str(e))
+            return None
+        if sub_cmd is not None:
+            if client is not None:
+                self.subscribe(client, cmd, *sub_cmd)
+            return None
+        device, device_cmd = self.resolve(cmd)
+        if device is None:
+            logging.warning('no device for cmd: %s' % cmd)
+            if client is not None:
+                self.send_message(client, {'command': cmd, 'error': 'unknown device'})
+            return None
+        future = device.submit(device_cmd, timeout)
+        if future is not None and client is not None:
+            future.add_done_callback(
+                lambda f, cmd=cmd, client=client: self._reply(client, cmd, f))
+        return future
+
+    def _reply(self, client, cmd, future):
+        if client.closed or future.cancelled():
+            return
+        if future.exception() is not None:
+            self.send_message(client, {'command': cmd, 'error': str(future.exception())})
+        elif future.result() is not None:
+            client.send(wire.encode(future.result(), client.format))
+
+    def send_message(self, client, obj):
+        data = wire.encode_message(obj, client.format)
+        if data is not None:
+            client.send(data)
+
+    def set_format(self, client, fmt):
+        if fmt not in wire.FORMATS:
+            self.send_message(client, {'command': 'format %s' % fmt, 'error': 'unknown format'})
+            return
+        # acknowledged in the format the client used so far
+        self.send_message(client, {'format': fmt})
+        client.format = fmt
+
+    def subscription_error(self, client, cmd, error):
+        # binary and raw have no messages, a line is better than silence
+        fmt = client.format if client.format in wire.MESSAGE_FORMATS else wire.FORMAT_NDJSON
+        client.send(wire.encode_message({'command': cmd, 'error': error}, fmt))
+
+    def subscribe(self, client, cmd, verb, device_id, args):
+        if client.format not in wire.MESSAGE_FORMATS:
+            self.subscription_error(client, cmd, 'subscribe in json or ndjson format')
+            return
+        if device_id != subscription.ANY_DEVICE and device_id not in self.devices:
+            self.subscription_error(client, cmd, 'unknown device')
+            return
+        sub = self.subscribers.command(client, verb, device_id, args)
+        self.send_message(client, {'subscriptions': sub.to_dict()})
+
+    def device_frame(self, device, pocket, solicited):
+        if len(self.subscribers):
+            self.push(device, pocket)
+        if not solicited and self.broadcast_unsolicited:
+            self.broadcast(pocket)
+
+    def push(self, device, pocket):
+        """the values of pocket to the clients subscribed to them"""
+        type_id = getattr(device, 'device_type_id', None)
+        for type_id, service_id, value in taiseia101.response_values(pocket, type_id):
+            encoded = {}
+            for client in self.subscribers.matches(device.device_id, service_id, value):
+                if client.format not in encoded:
+                    encoded[client.format] = wire.encode_value(
+                        device.device_id, type_id, service_id, value, pocket.timestamp, client.format)
+                data = encoded[client.format]
+                if data is not None:
+                    client.send(data)
+
+    def device_lost(self, device, exc):
+        device.stop()
+        self.devices.pop(device.device_id, None)
+        if not self.devices:
+            logging.warning('no device left, stop')
+            self.loop.stop()
+
+    def broadcast(self, pocket):
+        # serialized once per format, client queues share the result
+        encoder = wire.Encoder(pocket)
+        for client in list(self.clients):
+            client.send(encoder(client.format))
@@ -0,0 +1,282 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import taiseia101
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+MAGIC = b'TSH1'
+# magic, record size, capacity, head (next slot), count
+HEADER = struct.Struct('<4sHIII')
+HEADER_SIZE = 32
+# timestamp, value
+SAMPLE = struct.Struct('<dH')
+# bucket start, min, max, sum, count
+BUCKET = struct.Struct('<dHHdI')
+
+class RingBuffer(object):
+    """fixed size records in a ring, oldest overwritten first
+
+    Backed by a bytearray, or with a path by a memory mapped file that
+    keeps the records (and the ring position) across restarts. A file
+    written with another record size or capacity is started over.
+    """
+
+    def __init__(self, record, capacity, path=None):
+        self.record = record
+        self.capacity = capacity
+        self.path = path
+        size = HEADER_SIZE + record.size * capacity
+        self.file = None
+        if path is None:
+            self.buf = bytearray(size)
+            self.head = self.count = 0
+            return
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        self.file = open(path, 'r+b' if not fresh else 'w+b')
+        if fresh:
+            self.file.truncate(size)
+        self.buf = mmap.mmap(self.file.fileno(), size)
+        magic, record_size, capacity, head, count = HEADER.unpack_from(self.buf, 0)
+        if (fresh or magic != MAGIC or record_size != record.size or
+                capacity != self.capacity or head >= capacity or count > capacity):
+            if not fresh:
+                logging.warning('historian %s has another layout, start over' % path)
+            self.head = self.count = 0
+            self._write_header()
+        else:
+            self.head = head
+            self.count = count
+
+    def _write_header(self):
+        HEADER.pack_into(self.buf, 0, MAGIC, self.record.size, self.capacity, self.head, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def _offset(self, index):
+        """offset of the index-th oldest record"""
+        slot = (self.head - self.count + index) % self.capacity
+        return HEADER_SIZE + slot * self.record.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.record.unpack_from(self.buf, self._offset(index))
+
+    def append(self, *fields):
+        self.record.pack_into(self.buf, HEADER_SIZE + self.head * self.record.size, *fields)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    def replace_last(self, *fields):
+        self.record.pack_into(self.buf, self._offset(self.count - 1), *fields)
+
+    def bisect(self, timestamp):
+        """index of the first record at or after timestamp"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        """records with start <= timestamp < end, oldest first"""
+        for index in range(self.bisect(start), self.count):
+            rec = self[index]
+            if rec[0] >= end:
+                break
+            yield rec
+
+    def flush(self):
+        if self.file is not None:
+            self.buf.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.buf.flush()
+            self.buf.close()
+            self.file.close()
+            self.file = None
+
+class Series(object):
+    """one service of one device: raw samples plus per minute and per hour buckets
+
+    Raw samples cover the last raw_capacity values; older data is only
+    left in the buckets, minute buckets for minute_capacity minutes and
+    hour buckets for hour_capacity hours.
+    """
+
+    def __init__(self, path_prefix=None, raw_capacity=8640, minute_capacity=10080,
+                 hour_capacity=8760):
+        def path(tier):
+            return None if path_prefix is None else '%s.%s.ring' % (path_prefix, tier)
+        self.raw = RingBuffer(SAMPLE, raw_capacity, path('raw'))
+        self.tiers = (
+            (60, RingBuffer(BUCKET, minute_capacity, path('minute'))),
+            (3600, RingBuffer(BUCKET, hour_capacity, path('hour'))),
+            )
+
+    def append(self, timestamp, value):
+        self.raw.append(timestamp, value)
+        for width, ring in self.tiers:
+            start = timestamp - timestamp % width
+            if len(ring) and ring[-1][0] == start:
+                _, low, high, total, count = ring[-1]
+                ring.replace_last(start, min(low, value), max(high, value), total + value, count + 1)
+            else:
+                ring.append(start, value, value, value, 1)
+
+    def _source(self, start):
+        """the finest ring still holding data from start, None for raw
+
+        A ring that never overwrote a record holds everything recorded.
+        """
+        raw = self.raw
+        if len(raw) < raw.capacity or raw[0][0] <= start:
+            return None
+        for width, ring in self.tiers:
+            if len(ring) < ring.capacity or ring[0][0] <= start:
+                return ring
+        # nothing reaches back that far: the longest history there is
+        return self.tiers[-1][1]
+
+    def aggregate(self, start, end):
+        """{'min', 'max', 'mean', 'count'} over [start, end), None if no data
+
+        Once raw samples are gone the buckets starting within the window
+        are used, so its edges are only as exact as the bucket width.
+        """
+        low = high = None
+        total = 0.0
+        count = 0
+        ring = self._source(start)
+        if ring is None:
+            for timestamp, value in self.raw.range(start, end):
+                low = value if low is None else min(low, value)
+                high = value if high is None else max(high, value)
+                total += value
+                count += 1
+        else:
+            for bucket_start, b_low, b_high, b_total, b_count in ring.range(start, end):
+                low = b_low if low is None else min(low, b_low)
+                high = b_high if high is None else max(high, b_high)
+                total += b_total
+                count += b_count
+        if not count:
+            return None
+        return {'min': low, 'max': high, 'mean': total / count, 'count': count}
+
+    def windows(self, start, end, step):
+        """[(window start, aggregate or None), ...] for charts"""
+        result = []
+        t = start
+        while t < end:
+            result.append((t, self.aggregate(t, min(t + step, end))))
+            t += step
+        return result
+
+    def flush(self):
+        self.raw.flush()
+        for width, ring in self.tiers:
+            ring.flush()
+
+    def close(self):
+        self.raw.close()
+        for width, ring in self.tiers:
+            ring.close()
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(name))
+
+class Historian(object):
+    """recent values of selected services, per device and service
+
+    services: the (type_id, service_id) pairs to keep, None keeps all.
+    With a directory, every series lives in memory mapped files under
+    <directory>/<device>/<type_id>-<service_id>.*.ring and picks up where
+    it left after a restart.
+    """
+
+    def __init__(self, directory=None, services=None, **capacities):
+        self.directory = directory
+        self.services = None if services is None else set(services)
+        self.capacities = capacities
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _series(self, device_id, type_id, service_id, create):
+        key = (device_id, type_id, service_id)
+        series = self.series.get(key)
+        if series is not None:
+            return series
+        prefix = None
+        if self.directory is not None:
+            device_dir = os.path.join(self.directory, _safe_name(device_id))
+            prefix = os.path.join(device_dir, '%d-%d' % (type_id, service_id))
+            # a series recorded before a restart is opened for queries too
+            if not create and not os.path.exists(prefix + '.raw.ring'):
+                return None
+            if not os.path.isdir(device_dir):
+                os.makedirs(device_dir)
+        elif not create:
+            return None
+        series = self.series[key] = Series(prefix, **self.capacities)
+        return series
+
+    def record(self, device_id, type_id, service_id, value, timestamp=None):
+        if value is None or value == taiseia101.NO_VALUE:
+            return
+        if self.services is not None and (type_id, service_id) not in self.services:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self._series(device_id, type_id, service_id, True).append(timestamp, value)
+
+    def record_pocket(self, device_id, pocket, type_id=None):
+        """record the values of a response pocket, see taiseia101.response_values"""
+        for type_id, service_id, value in taiseia101.response_values(pocket, type_id):
+            self.record(device_id, type_id, service_id, value, pocket.timestamp)
+
+    def query(self, device_id, type_id, service_id, start, end=None):
+        """{'min', 'max', 'mean', 'count'} of a service over [start, end), None if no data"""
+        if end is None:
+            end = time.time()
+        with self.lock:
+            series = self._series(device_id, type_id, service_id, False)
+            if series is None:
+                return None
+            return series.aggregate(start, end)
+
+    def windows(self, device_id, type_id, service_id, start, end, step):
+        with self.lock:
+            series = self._series(device_id, type_id, service_id, False)
+            if series is None:
+                return []
+            return series.windows(start, end, step)
+
+    def flush(self):
+        with self.lock:
+            for series in self.series.values():
+                series.flush()
+
+    def close(self):
+        with self.lock:
+            for series in self.series.values():
+                series.close()
+            self.series.clear()
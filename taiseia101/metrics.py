@@ -0,0 +1,296 @@
+import BaseHTTPServer
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+import taiseia101
+import transaction
+import eventloop
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+# seconds; 9600 baud round trips take ~15ms on the wire, appliances add the rest
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items()))
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            bucket_labels = dict(labels)
+            bucket_labels['le'] = _format_value(bound)
+            yield name + '_bucket', bucket_labels, cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+class Metrics(object):
+    """counters and histograms in Prometheus text format
+
+    Counters and histograms are updated by the code that sees the event.
+    Values that already live elsewhere (decoder statistics, queue
+    lengths) come from collectors, functions called at render() time
+    that return [(name, labels, value), ...]; their names need a
+    describe().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.helps = {}
+        self.counters = collections.defaultdict(dict)
+        self.histograms = collections.defaultdict(dict)
+        self.collectors = []
+
+    def describe(self, name, kind, help_text):
+        self.kinds[name] = kind
+        self.helps[name] = help_text
+
+    def inc(self, name, labels=None, amount=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            family = self.counters[name]
+            family[key] = family.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            family = self.histograms[name]
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self):
+        samples = collections.defaultdict(list)
+        for collector in list(self.collectors):
+            try:
+                for name, labels, value in collector():
+                    samples[name].append((name, labels, value))
+            except Exception as e:
+                logging.warning('metrics collector %s failed: %s' % (collector, e))
+        with self.lock:
+            for name, family in self.counters.items():
+                for key, value in family.items():
+                    samples[name].append((name, dict(key), value))
+            for name, family in self.histograms.items():
+                for key, histogram in family.items():
+                    samples[name].extend(histogram.samples(name, dict(key)))
+        lines = []
+        for name in sorted(samples):
+            if name in self.helps:
+                lines.append('# HELP %s %s' % (name, self.helps[name]))
+                lines.append('# TYPE %s %s' % (name, self.kinds[name]))
+            for sample_name, labels, value in samples[name]:
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+def describe_gateway(metrics):
+    """the metric names the gateway and the threaded server report"""
+    metrics.describe('taiseia_request_latency_seconds', HISTOGRAM,
+                     'serial request to response time per service')
+    metrics.describe('taiseia_request_timeouts_total', COUNTER,
+                     'serial requests that got no response in time')
+    metrics.describe('taiseia_request_retransmits_total', COUNTER,
+                     'serial requests sent again after a timeout')
+    metrics.describe('taiseia_request_timeout_seconds', GAUGE,
+                     'current adaptive response timeout')
+    metrics.describe('taiseia_command_queue_depth', GAUGE,
+                     'commands waiting for the serial port or its response')
+    metrics.describe('taiseia_frames_decoded_total', COUNTER, 'valid frames read from the serial port')
+    metrics.describe('taiseia_frames_dropped_bytes_total', COUNTER,
+                     'bytes skipped while resyncing on the frame boundary')
+    metrics.describe('taiseia_frames_bad_check_sum_total', COUNTER, 'frames with a bad check sum')
+    metrics.describe('taiseia_frames_bad_length_total', COUNTER, 'frames with an impossible length byte')
+    metrics.describe('taiseia_client_send_backlog', GAUGE, 'messages queued for a TCP client')
+    metrics.describe('taiseia_client_dropped_total', COUNTER,
+                     'messages a slow TCP client did not get')
+    metrics.describe('taiseia_clients', GAUGE, 'connected TCP clients')
+
+def decoder_samples(device_id, decoder):
+    labels = {'device': device_id}
+    return [
+        ('taiseia_frames_decoded_total', labels, decoder.frames),
+        ('taiseia_frames_dropped_bytes_total', labels, decoder.dropped_bytes),
+        ('taiseia_frames_bad_check_sum_total', labels, decoder.bad_check_sum),
+        ('taiseia_frames_bad_length_total', labels, decoder.bad_length),
+        ]
+
+def client_samples(clients):
+    """clients: (name, fanout.SendQueue) pairs"""
+    samples = [('taiseia_clients', {}, len(clients))]
+    for name, queue in clients:
+        labels = {'client': name}
+        samples.append(('taiseia_client_send_backlog', labels, len(queue)))
+        samples.append(('taiseia_client_dropped_total', labels, queue.dropped))
+    return samples
+
+def service_labels(device_id, key):
+    """labels of a (type_id, service_id, is_read) transaction key"""
+    type_id, service_id, is_read = key
+    return {
+        'device': device_id,
+        'service_id': service_id,
+        'service': taiseia101.registry.service_name(type_id, service_id),
+        'op': 'read' if is_read else 'write',
+        }
+
+class LatencyTracker(object):
+    """request -> response latency for code without a TransactionTable
+
+    sent() notes the send time of a request frame, received() matches a
+    response frame to the oldest request with the same key. A request not
+    answered within timeout counts as a timeout.
+    """
+
+    def __init__(self, metrics, device_id, timeout=2.0):
+        self.metrics = metrics
+        self.device_id = device_id
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(collections.deque)
+
+    def sent(self, data, now=None):
+        key = transaction.request_key(data)
+        if key is None:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.pending[key].append(now)
+
+    def received(self, frame, now=None):
+        key = transaction.response_key(frame)
+        if now is None:
+            now = time.time()
+        with self.lock:
+            queue = self.pending.get(key)
+            sent = None
+            timeouts = 0
+            while queue:
+                sent = queue.popleft()
+                if now - sent <= self.timeout:
+                    break
+                timeouts += 1
+                sent = None
+        labels = service_labels(self.device_id, key)
+        if timeouts:
+            self.metrics.inc('taiseia_request_timeouts_total', labels, timeouts)
+        if sent is not None:
+            self.metrics.observe('taiseia_request_latency_seconds', now - sent, labels)
+
+    def depth(self, now=None):
+        """requests still waiting for a response, expired ones count as timeouts"""
+        if now is None:
+            now = time.time()
+        expired = []
+        with self.lock:
+            for key, queue in list(self.pending.items()):
+                n = 0
+                while queue and now - queue[0] > self.timeout:
+                    queue.popleft()
+                    n += 1
+                if n:
+                    expired.append((key, n))
+                if not queue:
+                    del self.pending[key]
+            depth = sum(len(q) for q in self.pending.values())
+        for key, n in expired:
+            self.metrics.inc('taiseia_request_timeouts_total', 
+                             service_labels(self.device_id, key), n)
+        return depth
+
+def loop_renderer(loop, metrics, timeout=2.0):
+    """render function running metrics.render() on the event loop thread,
+    so collectors can read state the loop owns"""
+    def render():
+        done = threading.Event()
+        result = []
+        def run():
+            try:
+                result.append(metrics.render())
+            finally:
+                done.set()
+        loop.call_soon_threadsafe(run)
+        if not done.wait(timeout) or not result:
+            raise eventloop.TimeoutError('event loop did not render metrics')
+        return result[0]
+    return render
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.render()
+        except Exception as e:
+            logging.warning('metrics render failed: %s' % e)
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics %s' % (format % args))
+
+class MetricsServer(object):
+    """serves render() at http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, render, port, host='127.0.0.1'):
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), _Handler)
+        self.httpd.render = render
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logging.info('metrics on http://%s:%s/metrics' % self.httpd.server_address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,83 @@
+import fcntl
+import json
+import logging
+import os
+import time
+import taiseia101
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+class RegistrationCache(object):
+    """register responses on disk, keyed by serial port
+
+    Each entry keeps the register response frame together with the device
+    identity it reported (model, protocol version), so a restarted
+    gateway can answer 'register' before talking to the device and check
+    the identity later with two short reads. The file is JSON:
+
+        {"<port>": {"frame": "<hex>", "model": ..., "protocol": [major, minor],
+                    "saved": <time>}, ...}
+
+    Several processes may share one file; every change rereads it under
+    an exclusive lock and replaces it atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError as e:
+            logging.warning('registration cache %s unreadable, ignored: %s' % (self.path, e))
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _update(self, change):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            change(entries)
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+
+    def get(self, port):
+        """(frame, model, (major, minor)) cached for port, None if there is none"""
+        entry = self._read().get(port)
+        if entry is None:
+            return None
+        try:
+            frame = bytearray(int(x, 16) for x in entry['frame'].split(','))
+            return frame, entry['model'], tuple(entry['protocol'])
+        except (KeyError, ValueError, TypeError) as e:
+            logging.warning('registration cache entry for %s broken: %s' % (port, e))
+            return None
+
+    def put(self, port, pocket):
+        """store a RegisterResponsePocket for port"""
+        protocol = pocket.protocol
+        entry = {
+            'frame': taiseia101.frame_hex(pocket.bytes),
+            'model': pocket.model,
+            'protocol': [protocol['major'], protocol['minor']],
+            'saved': time.time()
+            }
+        def change(entries):
+            entries[port] = entry
+        self._update(change)
+
+    def invalidate(self, port):
+        def change(entries):
+            entries.pop(port, None)
+        self._update(change)
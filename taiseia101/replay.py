@@ -0,0 +1,317 @@
+import binascii
+import collections
+import gzip
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+import taiseia101
+import transaction
+import metrics
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+RESPONSE_MARK = 'data frame hex:'
+COMMAND_MARK = 'send bytes command'
+
+_seconds = {}
+
+def open_log(path):
+    """a log file as lines, gzip when the name ends with .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def frame_lines(paths):
+    """(path, line) of the lines carrying a frame, files in the given order"""
+    for path in paths:
+        with open_log(path) as f:
+            for line in f:
+                if RESPONSE_MARK in line or COMMAND_MARK in line:
+                    yield path, line
+
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+def _timestamp(line):
+    """epoch seconds of the '%Y-%m-%d %H:%M:%S,mmm' log prefix, None without one"""
+    key = line[:19]
+    seconds = _seconds.get(key)
+    if seconds is None:
+        try:
+            seconds = time.mktime(time.strptime(key, '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            return None
+        if len(_seconds) > 100000:
+            _seconds.clear()
+        _seconds[key] = seconds
+    try:
+        return seconds + int(line[20:23]) / 1000.0
+    except ValueError:
+        return seconds
+
+def decode_batch(batch):
+    """[(path, line), ...] -> [(timestamp, device, is_response, frame, valid), ...]
+
+    Runs in the pool workers. device is the id logged in front of the
+    message, the file name for the threaded server that logs none; frame
+    is a str, valid tells whether its length and check sum hold.
+    """
+    records = []
+    for path, line in batch:
+        timestamp = _timestamp(line)
+        if timestamp is None:
+            continue
+        at = line.find(RESPONSE_MARK, 24)
+        is_response = at >= 0
+        if is_response:
+            end = at + len(RESPONSE_MARK)
+        else:
+            at = line.find(COMMAND_MARK, 24)
+            if at < 0:
+                continue
+            end = at + len(COMMAND_MARK)
+        # '<asctime> [LEVEL] logger: [device ]data frame hex: 06,04,1c,01,04,1b'
+        device = line[24:at].rstrip().rsplit(' ', 1)[-1]
+        if not device or device.endswith(':'):
+            device = os.path.basename(path).split('.')[0]
+        try:
+            frame = binascii.unhexlify(line[end:].strip().replace(',', ''))
+        except TypeError:
+            continue
+        data = bytearray(frame)
+        valid = (len(data) >= 3 and data[0] == len(data) and
+                 taiseia101.calc_check_sum(data[:-1]) == data[-1])
+        records.append((timestamp, device, is_response, frame, valid))
+    return records
+
+def decode(paths, workers=None, batch_size=2000, window=None):
+    """every frame record of the logs in order, decoded batch by batch in a process pool
+
+    At most window batches (default two per worker) are read ahead of
+    the consumer, so memory stays flat however large the logs are.
+    workers=0 decodes in this process.
+    """
+    chunks = batches(frame_lines(paths), batch_size)
+    if workers == 0:
+        for records in itertools.imap(decode_batch, chunks):
+            for record in records:
+                yield record
+        return
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if window is None:
+        window = 2 * workers
+    pool = multiprocessing.Pool(workers)
+    in_flight = collections.deque()
+    try:
+        for chunk in itertools.islice(chunks, window):
+            in_flight.append(pool.apply_async(decode_batch, (chunk,)))
+        while in_flight:
+            records = in_flight.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                in_flight.append(pool.apply_async(decode_batch, (chunk,)))
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+
+class ServiceStats(object):
+
+    def __init__(self, type_id, service_id):
+        self.type_id = type_id
+        self.service_id = service_id
+        self.reads = 0
+        self.writes = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.not_supported = 0
+        self.latency = metrics.Histogram()
+        self.latency_min = None
+        self.latency_max = None
+        self.timeline = []
+
+    def observe_latency(self, seconds):
+        self.latency.observe(seconds)
+        if self.latency_min is None or seconds < self.latency_min:
+            self.latency_min = seconds
+        if self.latency_max is None or seconds > self.latency_max:
+            self.latency_max = seconds
+
+    def value(self, timestamp, value):
+        if value == taiseia101.NO_VALUE:
+            self.not_supported += 1
+            return
+        if not self.timeline or self.timeline[-1][1] != value:
+            self.timeline.append((timestamp, value))
+
+    def _percentile(self, q):
+        """upper bound of the latency bucket holding the q quantile"""
+        rank = q * self.latency.count
+        cumulative = 0
+        for bound, count in zip(self.latency.buckets + (float('inf'),), self.latency.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound if bound != float('inf') else self.latency_max
+        return self.latency_max
+
+    def to_dict(self, timelines=True):
+        requests = self.reads + self.writes
+        result = {
+            'type_id': self.type_id,
+            'service_id': self.service_id,
+            'service': taiseia101.registry.service_name(self.type_id, self.service_id),
+            'reads': self.reads,
+            'writes': self.writes,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'not_supported': self.not_supported,
+            'error_rate': (float(self.timeouts + self.not_supported) / requests
+                           if requests else None),
+            'latency': None,
+            }
+        if self.latency.count:
+            result['latency'] = {
+                'count': self.latency.count,
+                'mean': self.latency.sum / self.latency.count,
+                'min': self.latency_min,
+                'max': self.latency_max,
+                'p50_le': self._percentile(0.5),
+                'p95_le': self._percentile(0.95),
+                }
+        if timelines:
+            result['timeline'] = self.timeline
+        return result
+
+class DeviceStats(object):
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.commands = 0
+        self.frames = 0
+        self.bad_frames = 0
+        self.unsolicited = 0
+        self.type_id = None
+        self.services = {}
+        # transaction key -> deque of (sent timestamp, ServiceStats)
+        self.pending = collections.defaultdict(collections.deque)
+
+    def service(self, type_id, service_id):
+        stats = self.services.get((type_id, service_id))
+        if stats is None:
+            stats = self.services[(type_id, service_id)] = ServiceStats(type_id, service_id)
+        return stats
+
+    def to_dict(self, timelines=True):
+        return {
+            'commands': self.commands,
+            'frames': self.frames,
+            'bad_frames': self.bad_frames,
+            'unsolicited': self.unsolicited,
+            'services': [self.services[key].to_dict(timelines) for key in sorted(self.services)],
+            }
+
+class LogAnalyzer(object):
+    """pairs logged commands with their responses, per device and service
+
+    A response answers the oldest command with the same transaction key
+    sent at most timeout seconds before it; older commands count as
+    timeouts. Values of every response, solicited or not, go to the
+    service timelines, which keep only the changes.
+    """
+
+    def __init__(self, timeout=2.0):
+        self.timeout = timeout
+        self.devices = {}
+        self.records = 0
+        self.first = None
+        self.last = None
+
+    def device(self, device_id):
+        stats = self.devices.get(device_id)
+        if stats is None:
+            stats = self.devices[device_id] = DeviceStats(device_id)
+        return stats
+
+    def feed(self, records):
+        for timestamp, device_id, is_response, frame, valid in records:
+            self.records += 1
+            if self.first is None:
+                self.first = timestamp
+            self.last = timestamp
+            dev = self.device(device_id)
+            data = bytearray(frame)
+            if not valid:
+                dev.bad_frames += 1
+                continue
+            if is_response:
+                self._response(dev, timestamp, data)
+            else:
+                self._command(dev, timestamp, data)
+
+    def _command(self, dev, timestamp, data):
+        dev.commands += 1
+        key = transaction.request_key(data)
+        if key is None:
+            return
+        stats = dev.service(data[1], data[2] & 0x7f)
+        if key[2]:
+            stats.reads += 1
+        else:
+            stats.writes += 1
+        dev.pending[key].append((timestamp, stats))
+
+    def _response(self, dev, timestamp, data):
+        dev.frames += 1
+        queue = dev.pending.get(transaction.response_key(data))
+        stats = None
+        while queue:
+            sent, stats = queue.popleft()
+            if timestamp - sent <= self.timeout:
+                break
+            stats.timeouts += 1
+            stats = None
+        if stats is None:
+            dev.unsolicited += 1
+        else:
+            stats.responses += 1
+            stats.observe_latency(timestamp - sent)
+        if data[1] != taiseia101._type_Register:
+            dev.type_id = data[1]
+            if len(data) >= 6:
+                dev.service(data[1], data[2] & 0x7f).value(timestamp, data[3] * 0x100 + data[4])
+        elif taiseia101.is_services_status_frame(data):
+            if dev.type_id is not None:
+                for view in taiseia101.service_views(data, 3):
+                    dev.service(dev.type_id, view.service_id).value(timestamp, view.value)
+        elif (stats is not None and stats.service_id == taiseia101._srv_Register and 
+                len(data) >= 8):
+            # after the fragment offset, as in RegisterResponsePocket
+            dev.type_id = data[6] * 0x100 + data[7]
+
+    def finish(self):
+        """commands still waiting at the end of the logs count as timeouts"""
+        for dev in self.devices.values():
+            for queue in dev.pending.values():
+                for sent, stats in queue:
+                    stats.timeouts += 1
+            dev.pending.clear()
+
+    def to_dict(self, timelines=True):
+        return {
+            'records': self.records,
+            'first': self.first,
+            'last': self.last,
+            'devices': dict((device_id, dev.to_dict(timelines))
+                            for device_id, dev in sorted(self.devices.items())),
+            }
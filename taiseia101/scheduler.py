@@ -0,0 +1,108 @@
+import logging
+import os
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+def frame_budget(baudrate, share=0.5, request_length=6, response_length=6, bits_per_byte=10):
+    """request/response pairs per second that fit in share of the bus"""
+    return share * baudrate / float(bits_per_byte * (request_length + response_length))
+
+class PollEntry(object):
+
+    def __init__(self, type_id, service_id, interval, min_interval, max_interval):
+        self.type_id = type_id
+        self.service_id = service_id
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.next_time = 0
+        self.last_value = None
+        self.polls = 0
+
+class PollScheduler(object):
+    """background reads with per service intervals under a frames/second budget
+
+    A value that comes back unchanged stretches its interval by backoff up
+    to max_interval, a changed value shrinks it by speedup down to
+    min_interval. Any response for the service, polled or not, counts as a
+    fresh sample and pushes the next poll out by the current interval.
+    When more reads are due than the budget allows, the most overdue go
+    first.
+    """
+
+    def __init__(self, loop, send, fps_budget, backoff=1.5, speedup=0.5):
+        self.loop = loop
+        self.send = send
+        self.fps_budget = fps_budget
+        self.backoff = backoff
+        self.speedup = speedup
+        self.entries = {}
+        self.tokens = 1.0
+        self.last_refill = None
+        self.timer = None
+
+    def add(self, type_id, service_id, interval, min_interval=None, max_interval=None):
+        if min_interval is None:
+            min_interval = interval / 2.0
+        if max_interval is None:
+            max_interval = interval * 8
+        entry = PollEntry(type_id, service_id, interval, min_interval, max_interval)
+        self.entries[(type_id, service_id)] = entry
+        return entry
+
+    def start(self):
+        now = self.loop.time()
+        self.last_refill = now
+        for entry in self.entries.values():
+            entry.next_time = now
+        self._schedule(now)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def observe(self, type_id, service_id, value):
+        entry = self.entries.get((type_id, service_id))
+        if entry is None:
+            return
+        if entry.last_value is not None:
+            if value == entry.last_value:
+                entry.interval = min(entry.max_interval, entry.interval * self.backoff)
+            else:
+                entry.interval = max(entry.min_interval, entry.interval * self.speedup)
+        entry.last_value = value
+        entry.next_time = self.loop.time() + entry.interval
+
+    def _refill(self, now):
+        burst = max(1.0, self.fps_budget)
+        self.tokens = min(burst, self.tokens + (now - self.last_refill) * self.fps_budget)
+        self.last_refill = now
+
+    def _tick(self):
+        self.timer = None
+        now = self.loop.time()
+        self._refill(now)
+        due = sorted((entry for entry in self.entries.values() if entry.next_time <= now),
+                     key=lambda entry: entry.next_time)
+        for entry in due:
+            if self.tokens < 1.0:
+                break
+            self.tokens -= 1.0
+            entry.polls += 1
+            # pushed out again by observe() once the response arrives
+            entry.next_time = now + entry.interval
+            self.send(entry.type_id, entry.service_id)
+        self._schedule(now)
+
+    def _schedule(self, now):
+        if not self.entries:
+            return
+        when = min(entry.next_time for entry in self.entries.values())
+        if self.tokens < 1.0:
+            when = max(when, now + (1.0 - self.tokens) / self.fps_budget)
+        self.timer = self.loop.call_at(max(when, now), self._tick)
@@ -0,0 +1,61 @@
+import time
+
+class ShadowEntry(object):
+
+    def __init__(self, value, pocket, timestamp, optimistic):
+        self.value = value
+        self.pocket = pocket
+        self.timestamp = timestamp
+        self.optimistic = optimistic
+        self.last_access = None
+
+class DeviceShadow(object):
+    """last known service values of one device, keyed by (type_id, service_id)
+
+    Every decoded response updates its entry. An entry younger than ttl
+    seconds can answer a read without a serial round trip. Writes are
+    stored optimistically (pocket None) until the device confirms them.
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, type_id, service_id, value, pocket=None, now=None, optimistic=False):
+        if now is None:
+            now = time.time()
+        entry = self.entries.get((type_id, service_id))
+        if entry is None:
+            self.entries[(type_id, service_id)] = ShadowEntry(value, pocket, now, optimistic)
+        else:
+            entry.value = value
+            entry.pocket = pocket
+            entry.timestamp = now
+            entry.optimistic = optimistic
+
+    def invalidate(self, type_id, service_id):
+        self.entries.pop((type_id, service_id), None)
+
+    def get(self, type_id, service_id, now=None):
+        """fresh entry or None"""
+        if now is None:
+            now = time.time()
+        entry = self.entries.get((type_id, service_id))
+        if entry is None or now - entry.timestamp > self.ttl:
+            self.misses += 1
+            return None
+        entry.last_access = now
+        self.hits += 1
+        return entry
+
+    def stale(self, age=None, now=None):
+        """keys of entries older than age (default ttl) read since their last update"""
+        if age is None:
+            age = self.ttl
+        if now is None:
+            now = time.time()
+        return [key for key, entry in self.entries.items()
+                if now - entry.timestamp > age and
+                entry.last_access is not None and entry.last_access >= entry.timestamp]
@@ -0,0 +1,214 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+import taiseia101
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+MAGIC = b'TSST'
+VERSION = 1
+# magic, version, device slots, slot size
+HEADER = struct.Struct('<4sHHI')
+HEADER_SIZE = 64
+SERVICES = 0x80
+# sequence, device id, type id, last update
+SLOT_HEAD = struct.Struct('<I32sHd')
+SEQ = struct.Struct('<I')
+SLOT_INFO = struct.Struct('<32sHd')
+# last update (0 never), value; indexed by service id
+SERVICE = struct.Struct('<dH')
+SERVICE_TABLE = struct.Struct('<' + 'dH' * SERVICES)
+SLOT_SIZE = (SLOT_HEAD.size + SERVICE.size * SERVICES + 63) // 64 * 64
+
+class TableFullError(Exception):
+    pass
+
+class StateTable(object):
+    """latest service values of every device, in a memory mapped file
+
+    The file has a fixed layout: a header, then max_devices slots of
+    SLOT_SIZE bytes. A slot holds a sequence number, the device id and
+    type id and, per service id, the value and the time it was read.
+    Each slot has one writer (the process serving the device); it makes
+    the sequence odd, writes, and makes it even again, so readers in
+    other processes can tell a torn copy from a consistent one without
+    a lock (a seqlock). A device claims the first free slot under an
+    flock of the file, and gets the same slot back after a restart.
+    """
+
+    def __init__(self, path, max_devices=16):
+        self.path = path
+        self.max_devices = max_devices
+        size = HEADER_SIZE + SLOT_SIZE * max_devices
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if not fresh:
+                self.buf = mmap.mmap(fd, size)
+                magic, version, devices, slot_size = HEADER.unpack_from(self.buf, 0)
+                fresh = (magic, version, devices, slot_size) != (MAGIC, VERSION, max_devices, SLOT_SIZE)
+                if fresh:
+                    logging.warning('state table %s has another layout, start over' % path)
+                    self.buf.close()
+            if fresh:
+                self.file.truncate(0)
+                self.file.truncate(size)
+                self.buf = mmap.mmap(fd, size)
+                HEADER.pack_into(self.buf, 0, MAGIC, VERSION, max_devices, SLOT_SIZE)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.slots = {}
+
+    def _slot(self, device_id):
+        offset = self.slots.get(device_id)
+        if offset is not None:
+            return offset
+        name = str(device_id)[:32]
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            free = None
+            for index in range(self.max_devices):
+                at = HEADER_SIZE + index * SLOT_SIZE
+                seq, slot_name, type_id, updated = SLOT_HEAD.unpack_from(self.buf, at)
+                slot_name = slot_name.rstrip(b'\x00')
+                if slot_name == name:
+                    offset = at
+                    break
+                if not slot_name and free is None:
+                    free = at
+            if offset is None:
+                if free is None:
+                    raise TableFullError('no free slot for %s in %s' % (device_id, self.path))
+                offset = free
+                self.buf[offset:offset + SLOT_SIZE] = b'\x00' * SLOT_SIZE
+                SLOT_HEAD.pack_into(self.buf, offset, 0, name, 0, 0.0)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.slots[device_id] = offset
+        return offset
+
+    def update(self, device_id, type_id, values, timestamp=None):
+        """values: [(service_id, value), ...] read from the device at timestamp"""
+        if timestamp is None:
+            timestamp = time.time()
+        offset = self._slot(device_id)
+        buf = self.buf
+        seq = SEQ.unpack_from(buf, offset)[0]
+        SEQ.pack_into(buf, offset, (seq + 1) & 0xffffffff)
+        SLOT_INFO.pack_into(buf, offset + SEQ.size, str(device_id)[:32], type_id, timestamp)
+        for service_id, value in values:
+            SERVICE.pack_into(buf, offset + SLOT_HEAD.size + (service_id & 0x7f) * SERVICE.size,
+                              timestamp, value)
+        SEQ.pack_into(buf, offset, (seq + 2) & 0xffffffff)
+
+    def publish_pocket(self, device_id, pocket, type_id=None):
+        """publish the values of a response pocket, see taiseia101.response_values"""
+        values = taiseia101.response_values(pocket, type_id)
+        if values:
+            self.update(device_id, values[0][0],
+                        [(service_id, value) for _, service_id, value in values],
+                        pocket.timestamp)
+
+    def close(self):
+        if self.file is not None:
+            self.buf.flush()
+            self.buf.close()
+            self.file.close()
+            self.file = None
+
+class StateReader(object):
+    """lock free reads of a StateTable from any process
+
+    snapshot(device_id) copies the device slot and retries while the
+    writer is in the middle of an update, so all values of a snapshot
+    come from the same update. Devices not in the table read as None.
+    """
+
+    def __init__(self, path, retries=1000):
+        self.path = path
+        self.retries = retries
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, devices, slot_size = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            raise ValueError('%s is not a version %s state table' % (path, VERSION))
+        self.max_devices = devices
+        self.slots = {}
+
+    def _read(self, offset, start=0, size=SLOT_SIZE):
+        """consistent copy of size bytes from start of the slot at offset"""
+        buf = self.buf
+        for attempt in range(self.retries):
+            seq = SEQ.unpack_from(buf, offset)[0]
+            if not seq & 1:
+                raw = buf[offset + start:offset + start + size]
+                if SEQ.unpack_from(buf, offset)[0] == seq:
+                    return raw
+            # let the writer finish, it may be waiting for our CPU
+            time.sleep(0 if attempt < 10 else 0.0005)
+        raise RuntimeError('state table slot %s kept changing' % offset)
+
+    def devices(self):
+        """ids of the devices in the table"""
+        result = []
+        for index in range(self.max_devices):
+            name = SLOT_HEAD.unpack_from(self.buf, HEADER_SIZE + index * SLOT_SIZE)[1]
+            name = name.rstrip(b'\x00')
+            if name:
+                result.append(name)
+        return result
+
+    def _find(self, device_id):
+        name = str(device_id)[:32]
+        offset = self.slots.get(name)
+        if offset is not None:
+            return offset
+        for index in range(self.max_devices):
+            at = HEADER_SIZE + index * SLOT_SIZE
+            if SLOT_HEAD.unpack_from(self.buf, at)[1].rstrip(b'\x00') == name:
+                self.slots[name] = at
+                return at
+        return None
+
+    def snapshot(self, device_id):
+        """{'device', 'type_id', 'updated', 'values': {service_id: (value, read at)}} or None"""
+        offset = self._find(device_id)
+        if offset is None:
+            return None
+        raw = self._read(offset)
+        seq, name, type_id, updated = SLOT_HEAD.unpack_from(raw, 0)
+        if name.rstrip(b'\x00') != str(device_id)[:32]:
+            # the slot was given to another device
+            self.slots.pop(str(device_id)[:32], None)
+            return None
+        table = SERVICE_TABLE.unpack_from(raw, SLOT_HEAD.size)
+        values = {}
+        for service_id in range(SERVICES):
+            read_at = table[2 * service_id]
+            if read_at:
+                values[service_id] = (table[2 * service_id + 1], read_at)
+        return {'device': device_id, 'type_id': type_id, 'updated': updated, 'values': values}
+
+    def value(self, device_id, service_id):
+        """(value, read at) of one service, None if never read"""
+        offset = self._find(device_id)
+        if offset is None:
+            return None
+        read_at, value = SERVICE.unpack(self._read(
+            offset, SLOT_HEAD.size + (service_id & 0x7f) * SERVICE.size, SERVICE.size))
+        if not read_at:
+            return None
+        return value, read_at
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
@@ -0,0 +1,183 @@
+import collections
+import threading
+import taiseia101
+
+ANY_DEVICE = '*'
+
+SUBSCRIBE = 'subscribe'
+UNSUBSCRIBE = 'unsubscribe'
+DELTA = 'delta'
+LIST = 'subscriptions'
+COMMANDS = (SUBSCRIBE, UNSUBSCRIBE, DELTA, LIST)
+
+def resolve_service(token):
+    """service id of a name (any case, like the commands) or number; None if unknown"""
+    if token.isdigit():
+        service_id = int(token)
+        return service_id if service_id < 0x80 else None
+    token = token.lower()
+    for type_id, ids in sorted(taiseia101.registry.service_ids.items()):
+        if type_id == taiseia101._type_Register:
+            continue
+        for name, service_id in ids.items():
+            if name.lower() == token:
+                return service_id
+    return None
+
+def parse_command(cmd):
+    """subscription command line -> (verb, device_id, args), None for other commands
+
+        [@device] subscribe <service>[:deadband] ...
+        [@device] unsubscribe [<service> ...]
+        delta on|off
+        subscriptions
+
+    Without @device a subscription covers every device (ANY_DEVICE).
+    Raises ValueError on a malformed subscription command.
+    """
+    device_id = ANY_DEVICE
+    parts = cmd.split()
+    if parts and parts[0][:1] == '@':
+        device_id = parts[0][1:]
+        parts = parts[1:]
+    if not parts or parts[0] not in COMMANDS:
+        return None
+    verb, args = parts[0], parts[1:]
+    if verb == DELTA:
+        if args not in (['on'], ['off']):
+            raise ValueError('delta on|off')
+        return verb, device_id, args[0] == 'on'
+    if verb == LIST:
+        return verb, device_id, None
+    services = []
+    for arg in args:
+        name, _, deadband = arg.partition(':')
+        service_id = resolve_service(name)
+        if service_id is None:
+            raise ValueError('unknown service %s' % name)
+        try:
+            deadband = float(deadband) if deadband else 0.0
+        except ValueError:
+            raise ValueError('bad deadband %s' % arg)
+        services.append((service_id, deadband))
+    if verb == SUBSCRIBE and not services:
+        raise ValueError('subscribe needs a service')
+    return verb, device_id, services
+
+class Subscription(object):
+    """the (device, service_id) pairs one client wants pushed
+
+    By default every value read from a subscribed service is pushed.
+    With delta on, only values that differ from the last one pushed to
+    this client; a service with a deadband only gets values more than
+    deadband away from the last one pushed, delta on or not.
+    """
+
+    def __init__(self):
+        self.services = {}
+        self.delta = False
+        self.last = {}
+
+    def deadband(self, device_id, service_id):
+        """deadband of the pair, None if not subscribed"""
+        deadband = self.services.get((device_id, service_id))
+        if deadband is None:
+            deadband = self.services.get((ANY_DEVICE, service_id))
+        return deadband
+
+    def offer(self, device_id, service_id, value):
+        """whether value should go out, noted as pushed if so"""
+        deadband = self.deadband(device_id, service_id)
+        if deadband is None:
+            return False
+        key = (device_id, service_id)
+        last = self.last.get(key)
+        if last is not None:
+            if deadband > 0 and abs(value - last) <= deadband:
+                return False
+            if self.delta and value == last:
+                return False
+        self.last[key] = value
+        return True
+
+    def to_dict(self):
+        return {
+            'delta': self.delta,
+            'services': [{'device': device_id, 'service_id': service_id, 'deadband': deadband}
+                         for (device_id, service_id), deadband in sorted(self.services.items())],
+            }
+
+class Subscribers(object):
+    """Subscription per client, indexed by (device, service_id) for fan-out
+
+    matches() only looks at the clients subscribed to a service, so the
+    work per decoded value grows with interest, not with the number of
+    clients. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.index = collections.defaultdict(set)
+
+    def __len__(self):
+        """number of (device, service_id) pairs someone subscribed to"""
+        return len(self.index)
+
+    def __contains__(self, client):
+        """whether client is subscribed to any service"""
+        sub = self.clients.get(client)
+        return sub is not None and bool(sub.services)
+
+    def get(self, client):
+        return self.clients.get(client)
+
+    def command(self, client, verb, device_id, args):
+        """apply a parse_command() result, return the client's Subscription
+
+        delta on is kept for the services subscribed to later, it does
+        not make a client subscribed by itself.
+        """
+        with self.lock:
+            sub = self.clients.get(client)
+            if sub is None:
+                sub = Subscription()
+            if verb == SUBSCRIBE:
+                for service_id, deadband in args:
+                    sub.services[(device_id, service_id)] = deadband
+                    self.index[(device_id, service_id)].add(client)
+            elif verb == UNSUBSCRIBE:
+                for key in list(sub.services):
+                    if ((device_id == ANY_DEVICE or key[0] == device_id) and
+                            (not args or key[1] in [service_id for service_id, _ in args])):
+                        del sub.services[key]
+                        self._unindex(key, client)
+            elif verb == DELTA:
+                sub.delta = args
+            if sub.services or sub.delta:
+                self.clients[client] = sub
+            else:
+                self.clients.pop(client, None)
+            return sub
+
+    def _unindex(self, key, client):
+        clients = self.index.get(key)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.index[key]
+
+    def remove(self, client):
+        with self.lock:
+            sub = self.clients.pop(client, None)
+            if sub is not None:
+                for key in sub.services:
+                    self._unindex(key, client)
+
+    def matches(self, device_id, service_id, value):
+        """clients value should be pushed to"""
+        with self.lock:
+            clients = (self.index.get((device_id, service_id), set()) |
+                       self.index.get((ANY_DEVICE, service_id), set()))
+            return [client for client in clients
+                    if self.clients[client].offer(device_id, service_id, value)]
@@ -2,6 +2,10 @@ import sys
 import logging
 import os
 import json
+import struct
+import time
+import threading
+import collections
 
 log_level = os.getenv('LOG_LEVEL', 'DEBUG')
 numeric_level = getattr(logging, log_level.upper(), None)
@@ -46,22 +50,156 @@ _srv_ReadDeviceModel = 0x06
 _srv_ReadDeviceServices = 0x07
 _srv_ReadDeviceServicesStatus = 0x08
 
+def _load_id_table(module, prefix):
+    # dir() is sorted, so on a shared id the first name wins as it always did
+    names = {}
+    ids = {}
+    for entry in dir(module):
+        if entry.find(prefix) == 0:
+            name = entry.replace(prefix,'')
+            names.setdefault(getattr(module,entry), name)
+            ids[name] = getattr(module,entry)
+    return names, ids
+
+class ProtocolRegistry(object):
+    """id <-> name tables for device classes, types and per type services
+    
+    Tables are read from the module constants once, device modules add
+    their _srv_ table with register_device().
+    """
+    
+    def __init__(self):
+        self.class_names = {}
+        self.class_ids = {}
+        self.type_names = {}
+        self.type_ids = {}
+        self.service_names = {}
+        self.service_ids = {}
+        self.devices = {}
+        
+    def load(self, module):
+        self.class_names, self.class_ids = _load_id_table(module, '_cls_')
+        self.type_names, self.type_ids = _load_id_table(module, '_type_')
+        self.register_device(_type_Register, module)
+        
+    def register_device(self, type_id, module):
+        names, ids = _load_id_table(module, '_srv_')
+        self.service_names[type_id] = names
+        self.service_ids[type_id] = ids
+        self.devices[type_id] = module
+        
+    def class_name(self, class_id):
+        return self.class_names.get(class_id, '')
+    
+    def type_name(self, type_id):
+        return self.type_names.get(type_id, '')
+    
+    def service_name(self, type_id, service_id):
+        return self.service_names.get(type_id, {}).get(service_id, '')
+    
+    def service_id(self, type_id, name):
+        return self.service_ids.get(type_id, {}).get(name)
+    
+    def services(self, type_id):
+        """{name: service_id} of a registered device type"""
+        return self.service_ids.get(type_id, {})
+
+registry = ProtocolRegistry()
+registry.load(sys.modules[__name__])
+
 def get_device_class_name_by_id(class_id):
-    current_module = sys.modules[__name__]
-    for entry in dir(current_module):
-        if entry.find('_cls_') == 0:
-            if getattr(current_module,entry) == class_id:
-                return entry.replace('_cls_','')
-    return ''
-            
+    return registry.class_names.get(class_id, '')
 
 def get_device_type_name_by_id(type_id):
-    current_module = sys.modules[__name__]
-    for entry in dir(current_module):
-        if entry.find('_type_') == 0:
-            if getattr(current_module,entry) == type_id:
-                return entry.replace('_type_','')
-    return ''
+    return registry.type_names.get(type_id, '')
+
+def calc_check_sum(data):
+    check_sum = 0
+    for x in data:
+        check_sum ^= x
+    return check_sum
+
+def _index_zero(data, start):
+    # works on both the hex-parsed int list and a raw bytearray frame
+    if isinstance(data, bytearray):
+        return data.index(b'\x00', start)
+    return data.index(0, start)
+
+def frame_bytes(data):
+    """bytes/bytearray/memoryview -> bytearray frame
+
+    A bytearray is used as is. Anything else is copied once, since on
+    Python 2 only a bytearray indexes as ints; the parsers then read
+    their fields from this one frame.
+    """
+    if isinstance(data, bytearray):
+        return data
+    return bytearray(data)
+
+def _text(data, start, end):
+    # one slice of a bytearray frame, the hex-parsed int list needs wrapping
+    if isinstance(data, bytearray):
+        return data[start:end].decode("utf-8")
+    return bytearray(data[start:end]).decode("utf-8")
+
+def frame_hex(data):
+    return ','.join('{:02x}'.format(x) for x in bytearray(data))
+
+class FrameCache(object):
+    """bounded memo of encoded request frames, oldest entry evicted first"""
+    
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.frames = {}
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return len(self.frames)
+    
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return frame
+    
+    def put(self, key, frame):
+        with self.lock:
+            if key in self.frames:
+                return
+            if len(self.order) >= self.maxsize:
+                del self.frames[self.order.popleft()]
+            self.frames[key] = frame
+            self.order.append(key)
+            
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.order.clear()
+
+_frame_cache = FrameCache()
+
+def encode_request(type_id, is_read, service_id, value=0xffff):
+    """request frame as immutable bytes, served from _frame_cache when seen before"""
+    key = (type_id, service_id, True if is_read else False, value)
+    frame = _frame_cache.get(key)
+    if frame is None:
+        pdu = bytearray([
+            6,
+            type_id,
+            (0x7f & service_id) if is_read else (0x80 | service_id),
+            (value & 0xff00) >> 8,
+            (value & 0x00ff),
+            0
+            ])
+        pdu[-1] = calc_check_sum(pdu[:-1])
+        frame = bytes(pdu)
+        _frame_cache.put(key, frame)
+    return frame
 
 class CommonRequestPocket(object):
     
@@ -82,29 +220,56 @@ class CommonRequestPocket(object):
             self.low_byte_data,
             0
             ]
-        check_sum = 0
-        for x in pdu[:-1]:
-            check_sum ^= x
-        pdu[-1] = check_sum
-        logging.debug('%s pdu: %s' % (self.__class__.__name__,
-                                      ','.join('{:02x}'.format(x) for x in pdu)))
+        pdu[-1] = calc_check_sum(pdu[:-1])
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('%s pdu: %s' % (self.__class__.__name__,
+                                          ','.join('{:02x}'.format(x) for x in pdu)))
         return pdu
     
+    def encode(self):
+        return encode_request(self.type_id, self.is_read, self.service_id,
+                              self.high_byte_data * 0x100 + self.low_byte_data)
+    
+# fixed size binary record: type, service byte (0x80 = write), value, timestamp
+RECORD = struct.Struct('!BBHd')
+NO_VALUE = 0xffff
+
 class CommonResponsePocket(object):
+    """a response frame; length, data and hex renderings are read from bytes on demand"""
+    
+    __slots__ = ('bytes', 'timestamp', 'type_id', 'service_id')
     
     def __init__(self,data):
         self.bytes = data
-        self.length = data[0]
+        self.timestamp = time.time()
         self.type_id = data[1]
         if self.type_id != _type_Register:
             self.service_id = data[2] & 0x7f
-            self.data = data[3:-1]
-        else:
-            self.data = data[2:-1]
-        self.check_sum = data[-1]
         
-    def __str__(self):
-        obj = {
+    @property
+    def length(self):
+        return self.bytes[0]
+    
+    @property
+    def data(self):
+        if self.bytes[1] != _type_Register:
+            return self.bytes[3:-1]
+        return self.bytes[2:-1]
+    
+    @property
+    def check_sum(self):
+        return self.bytes[-1]
+        
+    @property
+    def value(self):
+        """16 bit service value of a status response, None otherwise"""
+        data = self.bytes
+        if data[1] == _type_Register or len(data) < 6:
+            return None
+        return data[3] * 0x100 + data[4]
+        
+    def to_dict(self):
+        return {
             'length': self.length,
             'type': {
                 'id': self.type_id,
@@ -113,7 +278,19 @@ class CommonResponsePocket(object):
             'service_id': getattr(self,'service_id'),
             'data_hex': ','.join('{:02x}'.format(x) for x in self.data)
             }
-        return json.dumps(obj,indent=2)
+        
+    def __str__(self):
+        return json.dumps(self.to_dict(),indent=2)
+    
+    def to_json(self):
+        """single line JSON"""
+        return json.dumps(self.to_dict(),separators=(',', ':'))
+    
+    def to_record(self):
+        """RECORD bytes, value NO_VALUE when the frame carries none"""
+        value = self.value
+        return RECORD.pack(self.bytes[1], self.bytes[2], 
+                           NO_VALUE if value is None else value, self.timestamp)
     
 class RegisterRequestPocket(CommonRequestPocket):
     
@@ -123,69 +300,131 @@ class RegisterRequestPocket(CommonRequestPocket):
             is_read=True,
             service_id=_srv_Register)
 
-class RegisterResponsePocket(CommonResponsePocket):
+class ServiceView(object):
+    """one 3 byte service entry of a frame, read in place"""
     
-    def __init__(self,data):
-        super(RegisterResponsePocket,self).__init__(data)
-        
-        self.device_class = {
-            'multi_byte_type': True if (data[2] & 0x80) else False,
-            'id': (data[2] & 0b00001111)
+    __slots__ = ('buf', 'offset')
+    
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+    
+    @property
+    def writable(self):
+        return True if self.buf[self.offset] & 0x80 else False
+    
+    @property
+    def service_id(self):
+        return self.buf[self.offset] & 0b01111111
+    
+    @property
+    def high_byte(self):
+        return self.buf[self.offset+1]
+    
+    @property
+    def low_byte(self):
+        return self.buf[self.offset+2]
+    
+    @property
+    def value(self):
+        return self.buf[self.offset+1] * 0x100 + self.buf[self.offset+2]
+    
+    @property
+    def pdu(self):
+        return list(self.buf[self.offset:self.offset+3])
+    
+    @property
+    def pdu_hex(self):
+        return ','.join('{:02x}'.format(x) for x in self.buf[self.offset:self.offset+3])
+    
+    def __getitem__(self, key):
+        # the dict keys parse_service_pdus() uses
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+    
+    def to_dict(self):
+        return {
+            'writable': self.writable,
+            'service_id': self.service_id,
+            'high_byte': self.high_byte,
+            'low_byte': self.low_byte,
+            'pdu_hex': self.pdu_hex,
+            'pdu': self.pdu
             }
 
-        self.protocol = {
-            'major': data[3],
-            'minor': data[4]
-            }
+def service_views(data, n_start):
+    """ServiceView per 3 byte service entry from n_start up to the check sum"""
+    return [ServiceView(data, offset) for offset in range(n_start, len(data) - 3, 3)]
 
-        self.fragment_offset = data[5]
+def parse_service_pdus(data, n_start):
+    """3 byte service entries from n_start up to the check sum"""
+    return [serv.to_dict() for serv in service_views(data, n_start)]
+
+def is_services_status_frame(data):
+    return (data[1] == _type_Register and 
+            (data[2] & 0x7f) == _srv_ReadDeviceServicesStatus)
+
+class RegisterResponsePocket(CommonResponsePocket):
+    
+    __slots__ = ('brand', 'model', 'services_start')
+    
+    def __init__(self,data):
+        super(RegisterResponsePocket,self).__init__(data)
 
         self.type_id = data[6] * 0x100 + data[7]
 
         try:
-            n_zero = data[8:].index(0)
+            n_zero = _index_zero(data, 8)
         except:
             logging.error('RegisterResponsePocket parsing brand error')
             raise Exception('RegisterResponsePocket data parsing error')
             
-        self.brand = bytearray(data[8:8+n_zero]).decode("utf-8") 
+        self.brand = _text(data, 8, n_zero)
         
         try:
-            n_start = 8+n_zero+1
-            n_zero = data[n_start:].index(0)
+            n_start = n_zero+1
+            n_zero = _index_zero(data, n_start)
         except:
             logging.error('RegisterResponsePocket parsing model error')
             raise Exception('RegisterResponsePocket data parsing error')
 
-        self.model = bytearray(data[n_start:n_start+n_zero]).decode("utf-8") 
+        self.model = _text(data, n_start, n_zero)
         
-        n_start = n_start+n_zero+1
-        #pocket.service_pdu_list = []
-        self.services = []
-        while len(data) > (n_start+3):
-            serv_pdu = data[n_start:n_start+3]
-            serv = {
-                'writable': True if serv_pdu[0] & 0x80 else False,
-                'service_id': serv_pdu[0] & 0b01111111,
-                'high_byte': serv_pdu[1],
-                'low_byte': serv_pdu[2],
-                'pdu_hex': ','.join('{:02x}'.format(x) for x in serv_pdu),
-                'pdu': serv_pdu
-                }
-            self.services.append(serv)
-            n_start += 3
+        self.services_start = n_zero+1
 
-    def __str__(self):
-        obj = {
+    @property
+    def device_class(self):
+        return {
+            'multi_byte_type': True if (self.bytes[2] & 0x80) else False,
+            'id': (self.bytes[2] & 0b00001111)
+            }
+
+    @property
+    def protocol(self):
+        return {
+            'major': self.bytes[3],
+            'minor': self.bytes[4]
+            }
+
+    @property
+    def fragment_offset(self):
+        return self.bytes[5]
+
+    @property
+    def services(self):
+        return service_views(self.bytes, self.services_start)
+
+    def to_dict(self):
+        device_class = self.device_class
+        return {
             'device_class': {
-                'multi_byte_type': self.device_class['multi_byte_type'],
-                'id': self.device_class['id'],
-                'name': get_device_class_name_by_id(self.device_class['id'])
-                },
-            'protocol': {
-                'major': self.protocol['major'],
-                'minor': self.protocol['minor']
+                'multi_byte_type': device_class['multi_byte_type'],
+                'id': device_class['id'],
+                'name': get_device_class_name_by_id(device_class['id'])
                 },
+            'protocol': self.protocol,
             'fragment_offset': self.fragment_offset,
             'type': {
                 'id': self.type_id,
@@ -195,9 +434,91 @@ class RegisterResponsePocket(CommonResponsePocket):
             'model': self.model,
             'service_count': len(self.services)
             }
-        return json.dumps(obj,indent=2)
     
+    def to_record(self):
+        # the device type id is the value of a register record
+        return RECORD.pack(_type_Register, _srv_Register, self.type_id & 0xffff, self.timestamp)
+    
+
+
+class ServicesStatusRequestPocket(CommonRequestPocket):
+    
+    def __init__(self):
+        super(ServicesStatusRequestPocket,self).__init__(
+            type_id=_type_Register,
+            is_read=True,
+            service_id=_srv_ReadDeviceServicesStatus)
+
+class ServicesStatusResponsePocket(CommonResponsePocket):
+    """all service values of a device in one ReadDeviceServicesStatus reply"""
+    
+    __slots__ = ()
+    
+    def __init__(self,data):
+        super(ServicesStatusResponsePocket,self).__init__(data)
+        self.service_id = data[2] & 0x7f
+    
+    @property
+    def services(self):
+        return service_views(self.bytes, 3)
+    
+    @property
+    def values(self):
+        """{service_id: value}"""
+        return dict((serv.service_id, serv.value) for serv in self.services)
+    
+    def to_dict(self):
+        return {
+            'length': self.length,
+            'type': {
+                'id': self.type_id,
+                'name': get_device_type_name_by_id(self.type_id)
+                },
+            'service_id': self.service_id,
+            'values': self.values
+            }
+    
+    def to_record(self):
+        """one RECORD per service, with the service byte as reported"""
+        return b''.join(RECORD.pack(_type_Register, self.bytes[serv.offset], 
+                                    serv.value, self.timestamp)
+                        for serv in self.services)
 
+class DeviceInfoResponsePocket(CommonResponsePocket):
+    """reply to one of the ReadDevice* info services (protocol version, model, ...)
+
+    The frame alone does not tell it from a register response, only the
+    request it answers does.
+    """
+    
+    __slots__ = ()
+    
+    def __init__(self,data):
+        super(DeviceInfoResponsePocket,self).__init__(data)
+        self.service_id = data[2] & 0x7f
+    
+    @property
+    def value(self):
+        if len(self.bytes) < 6:
+            return None
+        return self.bytes[3] * 0x100 + self.bytes[4]
+    
+    @property
+    def protocol(self):
+        return {
+            'major': self.bytes[3],
+            'minor': self.bytes[4]
+            }
+    
+    @property
+    def text(self):
+        """data as a string, for brand and model"""
+        return bytearray(self.bytes[3:-1]).rstrip(b'\x00').decode("utf-8")
+    
+    def to_dict(self):
+        obj = super(DeviceInfoResponsePocket,self).to_dict()
+        obj['service_name'] = registry.service_name(_type_Register, self.service_id)
+        return obj
 
 class DeviceInfoReadPocket(CommonRequestPocket):
     pass
@@ -220,10 +541,28 @@ class DeviceStatusWritePocket(CommonRequestPocket):
             service_id=service_id,
             value=value)
 
+def response_values(pocket, type_id=None):
+    """[(type_id, service_id, value), ...] a response pocket reports
+
+    A services status response carries no type id, type_id is the one
+    the device registered with; without it the pocket reports nothing,
+    as do register and device info responses.
+    """
+    if isinstance(pocket, ServicesStatusResponsePocket):
+        if type_id is None:
+            return []
+        return [(type_id, serv.service_id, serv.value) for serv in pocket.services]
+    if pocket.bytes[1] == _type_Register:
+        return []
+    value = pocket.value
+    if value is None:
+        return []
+    return [(pocket.type_id, pocket.service_id, value)]
+
 def parse_response_pocket(hex_data):
 
     try:
-        data = [int(x,16) for x in hex_data.split(',')]
+        data = bytearray(int(x,16) for x in hex_data.split(','))
     except ValueError:
         logging.error('CommonResponsePocket init hex_data (%s) format error\n' % hex_data)
         return None
@@ -235,7 +574,29 @@ def parse_response_pocket(hex_data):
     type_id = data[1]
     logging.debug('parse_response_pocket type_id: %s' % type_id)
     
-    if type_id == _type_Register:
+    if is_services_status_frame(data):
+        pocket = ServicesStatusResponsePocket(data)
+    elif type_id == _type_Register:
+        pocket = RegisterResponsePocket(data)
+    else:
+        pocket = CommonResponsePocket(data)
+    
+    return pocket
+
+def parse_response_bytes(data):
+
+    data = frame_bytes(data)
+    if len(data) < 3 or len(data) != data[0]:
+        logging.error('CommonResponsePocket init frame (%s) length error\n' % 
+                      ','.join('{:02x}'.format(x) for x in data))
+        return None
+    
+    type_id = data[1]
+    logging.debug('parse_response_bytes type_id: %s' % type_id)
+    
+    if is_services_status_frame(data):
+        pocket = ServicesStatusResponsePocket(data)
+    elif type_id == _type_Register:
         pocket = RegisterResponsePocket(data)
     else:
         pocket = CommonResponsePocket(data)
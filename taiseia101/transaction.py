@@ -0,0 +1,183 @@
+import collections
+import logging
+import os
+import taiseia101
+import eventloop
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+def _frame_key(type_id, service_byte):
+    if type_id == taiseia101._type_Register:
+        return (taiseia101._type_Register, taiseia101._srv_Register, True)
+    return (type_id, service_byte & 0x7f, not (service_byte & 0x80))
+
+def request_key(data):
+    """(type_id, service_id, is_read) of an encoded request, None if too short"""
+    if len(data) < 3:
+        return None
+    head = bytearray(data[:3])
+    return _frame_key(head[1], head[2])
+
+def response_key(frame):
+    """(type_id, service_id, is_read) a response frame answers"""
+    return _frame_key(frame[1], frame[2])
+
+def repeatable(data, writes=()):
+    """whether sending request data twice does no harm
+
+    Reads always; writes only to the (type_id, service_id) pairs in
+    writes, services that set an absolute value.
+    """
+    key = request_key(data)
+    if key is None:
+        return False
+    return key[2] or (key[0], key[1]) in writes
+
+class RttEstimator(object):
+    """smoothed response time of one device and the timeout derived from it
+
+    As TCP does (RFC 6298): srtt and rttvar are moving averages of the
+    samples and of their deviation, the timeout is srtt + k * rttvar
+    within [min_timeout, max_timeout]. Every timeout doubles it until
+    the next sample. Before the first sample it is max_timeout.
+    """
+
+    def __init__(self, min_timeout=0.2, max_timeout=2.0, alpha=0.125, beta=0.25, k=4):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.srtt = None
+        self.rttvar = None
+        self.rto = max_timeout
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = max(self.min_timeout, min(self.max_timeout, self.srtt + self.k * self.rttvar))
+
+    def timeout(self):
+        return self.rto
+
+    def backoff(self):
+        self.rto = min(self.max_timeout, self.rto * 2)
+
+class Transaction(object):
+
+    def __init__(self, key, data, future, client=None):
+        self.key = key
+        self.data = data
+        self.future = future
+        self.client = client
+        self.sent_time = None
+        self.timer = None
+        self.timeout = None
+        self.attempts = 1
+        # whether it may go out again after a timeout
+        self.retry = False
+
+class TransactionTable(object):
+    """in-flight requests, answered in order per (type_id, service_id, is_read)
+
+    Requests for different keys are pipelined; requests for the same key are
+    queued and each response completes the oldest one. A transaction not
+    answered within its timeout fails with eventloop.TimeoutError, after
+    on_timeout(tr) if set.
+
+    With an RttEstimator, requests submitted without a timeout wait for
+    the adaptive one, and first attempts feed it their response time (a
+    response to a retransmitted request could answer either copy). A
+    transaction submitted with retry goes out again through
+    retransmit(tr) up to retries times before it times out.
+    """
+
+    def __init__(self, loop, timeout=2.0, rtt=None, retries=0, retransmit=None):
+        self.loop = loop
+        self.timeout = timeout
+        self.rtt = rtt
+        self.retries = retries
+        self.retransmit = retransmit
+        self.retransmits = 0
+        self.pending = collections.defaultdict(collections.deque)
+        self.on_timeout = None
+
+    def __len__(self):
+        return sum(len(q) for q in self.pending.values())
+
+    def submit(self, key, data, client=None, timeout=None, retry=False):
+        future = self.loop.create_future()
+        tr = Transaction(key, data, future, client)
+        tr.sent_time = self.loop.time()
+        tr.retry = retry
+        self.pending[key].append(tr)
+        tr.timeout = timeout
+        if timeout is None:
+            timeout = self.rtt.timeout() if self.rtt is not None else self.timeout
+        if timeout:
+            tr.timer = self.loop.call_later(timeout, self._expire, tr)
+        return tr
+
+    def peek(self, key):
+        """oldest transaction waiting on key, None if there is none"""
+        queue = self.pending.get(key)
+        if not queue:
+            return None
+        return queue[0]
+
+    def match(self, frame, pocket):
+        """complete the oldest transaction answered by frame, None if unsolicited"""
+        key = response_key(frame)
+        queue = self.pending.get(key)
+        if not queue:
+            return None
+        tr = queue.popleft()
+        if not queue:
+            del self.pending[key]
+        if tr.timer is not None:
+            tr.timer.cancel()
+        if self.rtt is not None and tr.attempts == 1:
+            self.rtt.observe(self.loop.time() - tr.sent_time)
+        tr.future.set_result(pocket)
+        return tr
+
+    def _expire(self, tr):
+        queue = self.pending.get(tr.key)
+        if not queue or tr not in queue:
+            return
+        if self.rtt is not None:
+            self.rtt.backoff()
+        if tr.retry and tr.attempts <= self.retries and self.retransmit is not None:
+            tr.attempts += 1
+            self.retransmits += 1
+            tr.sent_time = self.loop.time()
+            timeout = tr.timeout
+            if timeout is None:
+                timeout = self.rtt.timeout() if self.rtt is not None else self.timeout
+            tr.timer = self.loop.call_later(timeout, self._expire, tr)
+            logging.info('transaction %s retransmit %s' % (tr.key, tr.attempts - 1))
+            self.retransmit(tr)
+            return
+        queue.remove(tr)
+        if not queue:
+            del self.pending[tr.key]
+        logging.warning('transaction %s timeout' % (tr.key,))
+        if self.on_timeout is not None:
+            self.on_timeout(tr)
+        tr.future.set_exception(eventloop.TimeoutError('no response for %s' % (tr.key,)))
+
+    def cancel_all(self):
+        for queue in self.pending.values():
+            for tr in queue:
+                if tr.timer is not None:
+                    tr.timer.cancel()
+                tr.future.cancel()
+        self.pending.clear()
@@ -0,0 +1,70 @@
+import json
+import struct
+import taiseia101
+
+# json    indented JSON per pocket, the original output
+# ndjson  one JSON object per line
+# binary  taiseia101.RECORD per value: type, service byte, value, timestamp;
+#         subscription pushes are a VALUE_RECORD, the device id in front
+# raw     the response frame as read from the serial port
+FORMAT_JSON = 'json'
+FORMAT_NDJSON = 'ndjson'
+FORMAT_BINARY = 'binary'
+FORMAT_RAW = 'raw'
+FORMATS = (FORMAT_JSON, FORMAT_NDJSON, FORMAT_BINARY, FORMAT_RAW)
+# formats gateway messages (acks, errors) can be written in
+MESSAGE_FORMATS = (FORMAT_JSON, FORMAT_NDJSON)
+
+# device id (zero padded), then the fields of taiseia101.RECORD
+VALUE_RECORD = struct.Struct('!32sBBHd')
+
+def encode(pocket, fmt):
+    """pocket as the bytes to send to a client using fmt"""
+    if fmt == FORMAT_NDJSON:
+        return pocket.to_json()+'\n'
+    if fmt == FORMAT_BINARY:
+        return pocket.to_record()
+    if fmt == FORMAT_RAW:
+        return bytes(pocket.bytes)
+    return str(pocket)+'\n'
+
+def encode_message(obj, fmt):
+    """gateway message (errors, device list) for a client, None if fmt has no room for it"""
+    if fmt == FORMAT_NDJSON:
+        return json.dumps(obj,separators=(',', ':'))+'\n'
+    if fmt == FORMAT_JSON:
+        return json.dumps(obj)+'\n'
+    return None
+
+def encode_value(device_id, type_id, service_id, value, timestamp, fmt):
+    """one service value pushed to a subscriber, None if fmt has no room for it"""
+    if fmt == FORMAT_BINARY:
+        return VALUE_RECORD.pack(str(device_id)[:32], type_id, service_id, value, timestamp)
+    return encode_message({
+        'device': device_id,
+        'type_id': type_id,
+        'service_id': service_id,
+        'service': taiseia101.registry.service_name(type_id, service_id),
+        'value': value,
+        'timestamp': timestamp,
+        }, fmt)
+
+class Encoder(object):
+    """encodes one pocket at most once per format, for fan-out to many clients"""
+
+    def __init__(self, pocket):
+        self.pocket = pocket
+        self.encoded = {}
+
+    def __call__(self, fmt):
+        data = self.encoded.get(fmt)
+        if data is None:
+            data = self.encoded[fmt] = encode(self.pocket, fmt)
+        return data
+
+def parse_format_command(cmd):
+    """'format <name>' -> name, None if cmd is something else"""
+    parts = cmd.split()
+    if len(parts) == 2 and parts[0] == 'format':
+        return parts[1]
+    return None
@@ -0,0 +1,280 @@
+import socket
+import errno
+import logging
+import os
+import multiprocessing
+import taiseia101
+import eventloop
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG')
+numeric_level = getattr(logging, log_level.upper(), None)
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % log_level)
+logging.basicConfig(level=numeric_level)
+
+# front -> worker:  <req_id> <device_id> <timeout|-> <command>
+# worker -> front:  <req_id> <device_id> F <frame hex>   response pocket frame
+#                   <req_id> <device_id> N               no response expected
+#                   <req_id> <device_id> E <message>     request failed
+#                   0 <device_id> L <message>            serial port lost
+#                   0 <device_id> S <frame hex>          a frame answering a request
+# req_id 0 with F is a frame nobody asked for.
+
+class WorkerError(Exception):
+    pass
+
+class LineChannel(object):
+    """newline separated messages over a non-blocking socket"""
+
+    def __init__(self, loop, sock, on_line, on_close):
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.on_line = on_line
+        self.on_close = on_close
+        self.in_buff = b''
+        self.out_buff = bytearray()
+        self.closed = False
+
+    def start(self):
+        self.sock.setblocking(False)
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self.close()
+            return
+        lines = (self.in_buff + data).split(b'\n')
+        self.in_buff = lines.pop()
+        for line in lines:
+            self.on_line(line)
+
+    def send(self, line):
+        if self.closed:
+            return
+        self.out_buff += line + b'\n'
+        if len(self.out_buff) == len(line) + 1:
+            self._on_writable()
+
+    def _on_writable(self):
+        try:
+            n = self.sock.send(self.out_buff)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.close()
+                return
+            n = 0
+        del self.out_buff[:n]
+        if self.out_buff:
+            self.loop.add_writer(self.fd, self._on_writable)
+        else:
+            self.loop.remove_writer(self.fd)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.sock.close()
+        self.on_close()
+
+class WorkerDevice(object):
+    """front side stand-in for a device served by a worker process"""
+
+    def __init__(self, worker, device_id, parse_frame):
+        self.worker = worker
+        self.device_id = device_id
+        self.parse_frame = parse_frame
+        self.listener = None
+        self.device_type_id = None
+
+    def submit(self, cmd, timeout=None):
+        return self.worker.request(self.device_id, cmd, timeout)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def learn(self, pocket):
+        """note the device type, as SerialDevice does, for services status pockets"""
+        if isinstance(pocket, taiseia101.RegisterResponsePocket):
+            self.device_type_id = pocket.type_id
+        elif pocket.bytes[1] != taiseia101._type_Register:
+            self.device_type_id = pocket.type_id
+
+class WorkerProcess(object):
+    """a child process running its own event loop for a share of the devices
+
+    make_device(loop, config) builds a gateway.SerialDevice for a config in
+    the child; parse_frame decodes the frames it returns in the front.
+    """
+
+    def __init__(self, loop, configs, make_device, parse_frame):
+        self.loop = loop
+        self.configs = configs
+        self.make_device = make_device
+        self.devices = {}
+        for config in configs:
+            self.devices[config['id']] = WorkerDevice(self, config['id'], parse_frame)
+        self.pending = {}
+        self.next_id = 1
+        self.channel = None
+        self.process = None
+
+    def start(self):
+        front_sock, worker_sock = socket.socketpair()
+        self.process = multiprocessing.Process(
+            target=worker_main, args=(worker_sock, front_sock, self.configs, self.make_device))
+        self.process.daemon = True
+        self.process.start()
+        worker_sock.close()
+        self.channel = LineChannel(self.loop, front_sock, self._on_line, self._on_close)
+        self.channel.start()
+        logging.info('worker %s serving %s' % (self.process.pid, ', '.join(sorted(self.devices))))
+
+    def stop(self):
+        if self.channel is not None:
+            self.channel.close()
+        if self.process is not None:
+            self.process.join(3)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+    def request(self, device_id, cmd, timeout=None):
+        if self.channel is None or self.channel.closed:
+            return None
+        req_id = self.next_id
+        self.next_id += 1
+        future = self.loop.create_future()
+        self.pending[req_id] = future
+        self.channel.send(b'%d %s %s %s' % (req_id, device_id,
+                                            '-' if timeout is None else repr(timeout), cmd))
+        return future
+
+    def _on_line(self, line):
+        parts = line.split(b' ', 3)
+        req_id = int(parts[0])
+        device = self.devices.get(parts[1])
+        kind = parts[2]
+        arg = parts[3] if len(parts) > 3 else b''
+        future = self.pending.pop(req_id, None)
+        if device is None:
+            if future is not None:
+                future.set_exception(WorkerError(arg or 'unknown device'))
+            return
+        if kind in (b'F', b'S'):
+            try:
+                pocket = device.parse_frame(bytearray(int(x, 16) for x in arg.split(b',')))
+            except Exception as e:
+                # one bad frame must not lose the lines after it
+                logging.error('%s worker frame %s not parsed: %s' % (device.device_id, arg, e))
+                if future is not None:
+                    future.set_exception(WorkerError('frame not parsed: %s' % e))
+                return
+            if pocket is not None:
+                device.learn(pocket)
+        if kind == b'F':
+            if future is not None:
+                future.set_result(pocket)
+            elif device.listener is not None:
+                device.listener.device_frame(device, pocket, False)
+        elif kind == b'S':
+            # answered a request, maybe one from this front; for subscribers
+            if pocket is not None and device.listener is not None:
+                device.listener.device_frame(device, pocket, True)
+        elif kind == b'N':
+            if future is not None:
+                future.set_result(None)
+        elif kind == b'E':
+            if future is not None:
+                future.set_exception(WorkerError(arg))
+        elif kind == b'L':
+            if device.listener is not None:
+                device.listener.device_lost(device, arg)
+
+    def _on_close(self):
+        logging.warning('worker channel closed')
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.cancel()
+        for device in list(self.devices.values()):
+            if device.listener is not None:
+                device.listener.device_lost(device, 'worker exit')
+
+class _WorkerServer(object):
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.devices = {}
+        self.channel = LineChannel(loop, sock, self._on_line, loop.stop)
+
+    def add_device(self, device):
+        device.listener = self
+        self.devices[device.device_id] = device
+
+    def _on_line(self, line):
+        req_id, device_id, timeout, cmd = line.split(b' ', 3)
+        device = self.devices.get(device_id)
+        if device is None:
+            self.channel.send(b'%s %s E unknown device' % (req_id, device_id))
+            return
+        future = device.submit(cmd, None if timeout == b'-' else float(timeout))
+        if future is None:
+            self.channel.send(b'%s %s N' % (req_id, device_id))
+        else:
+            future.add_done_callback(
+                lambda f, req_id=req_id, device_id=device_id: self._reply(req_id, device_id, f))
+
+    def _reply(self, req_id, device_id, future):
+        if future.exception() is not None:
+            self.channel.send(b'%s %s E %s' % (req_id, device_id, future.exception()))
+        else:
+            self.channel.send(b'%s %s F %s' % (req_id, device_id,
+                                               taiseia101.frame_hex(future.result().bytes)))
+
+    def device_frame(self, device, pocket, solicited):
+        if isinstance(pocket, taiseia101.DeviceInfoResponsePocket):
+            # only readable with the request that asked for it, which the
+            # front does not have (registration checks)
+            return
+        self.channel.send(b'0 %s %s %s' % (device.device_id, b'S' if solicited else b'F',
+                                           taiseia101.frame_hex(pocket.bytes)))
+
+    def device_lost(self, device, exc):
+        device.stop()
+        self.devices.pop(device.device_id, None)
+        self.channel.send(b'0 %s L %s' % (device.device_id, exc))
+
+def worker_main(sock, front_sock, configs, make_device):
+    front_sock.close()
+    loop = eventloop.EventLoop()
+    server = _WorkerServer(loop, sock)
+    for config in configs:
+        server.add_device(make_device(loop, config))
+    server.channel.start()
+    for device in server.devices.values():
+        device.start()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    for device in server.devices.values():
+        device.stop()
+    loop.close()
+
+def spread(configs, workers):
+    """round robin configs over at most workers lists"""
+    shares = [[] for _ in range(min(workers, len(configs)))]
+    for n, config in enumerate(configs):
+        shares[n % len(shares)].append(config)
+    return shares
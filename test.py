@@ -17,11 +17,13 @@ if __name__ == '__main__':
 #     sys.stderr.write('%s\n' % str(pocket))
 
     #-> test taiseia101.dehumiditifer
-    pocket = dehumiditifer.ServicePowerRequest(True)
+    pocket = dehumiditifer.service_write(dehumiditifer._srv_PowerControl, 
+                                         dehumiditifer.ServicePower.ON)
     pdu = pocket()
     hex_data = ','.join('{:02x}'.format(x) for x in pdu)
     sys.stderr.write('%s\n' % hex_data)
-    pocket = dehumiditifer.ServicePowerRequest(False)
+    pocket = dehumiditifer.service_write(dehumiditifer._srv_PowerControl, 
+                                         dehumiditifer.ServicePower.OFF)
     pdu = pocket()
     hex_data = ','.join('{:02x}'.format(x) for x in pdu)
     sys.stderr.write('%s\n' % hex_data)
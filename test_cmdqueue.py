@@ -0,0 +1,127 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import unittest
+from taiseia101 import taiseia101
+from taiseia101 import dehumiditifer
+from taiseia101 import eventloop
+from taiseia101 import gateway
+from taiseia101 import cmdqueue
+from test_shadow import FakeSerial, response
+
+TYPE = taiseia101._type_Dehumiditifer
+OPMODE = dehumiditifer._srv_OpModeConfig
+POWER = dehumiditifer._srv_PowerControl
+
+def read(service_id, type_id=TYPE):
+    return taiseia101.encode_request(type_id, True, service_id)
+
+def write(service_id, value, type_id=TYPE):
+    return taiseia101.encode_request(type_id, False, service_id, value)
+
+class CommandQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = cmdqueue.CommandQueue(starvation_limit=2)
+
+    def test_identical_reads_merge(self):
+        first = self.queue.put(read(OPMODE), waiter='a')
+        second = self.queue.put(read(OPMODE), waiter='b')
+        self.assertIs(first, second)
+        self.assertEqual(first.waiters, ['a', 'b'])
+        self.assertEqual((len(self.queue), self.queue.coalesced), (1, 1))
+
+    def test_different_reads_stay_apart(self):
+        self.queue.put(read(OPMODE))
+        self.queue.put(read(POWER))
+        self.queue.put(read(OPMODE, type_id=TYPE + 1))
+        self.assertEqual(len(self.queue), 3)
+
+    def test_latest_write_wins(self):
+        cmd = self.queue.put(write(OPMODE, 1))
+        self.queue.put(write(OPMODE, 2))
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(cmd.data, write(OPMODE, 2))
+
+    def test_register_and_status_reads_stay_apart(self):
+        self.queue.put(read(taiseia101._srv_Register, taiseia101._type_Register))
+        self.queue.put(read(taiseia101._srv_ReadDeviceServicesStatus, taiseia101._type_Register))
+        self.assertEqual(len(self.queue), 2)
+
+    def test_interactive_read_promotes_background_one(self):
+        self.queue.put(read(POWER), cmdqueue.INTERACTIVE)
+        cmd = self.queue.put(read(OPMODE), cmdqueue.BACKGROUND)
+        self.queue.put(read(OPMODE), cmdqueue.INTERACTIVE)
+        self.assertEqual(cmd.lane, cmdqueue.INTERACTIVE)
+        self.assertEqual(self.queue.depth(cmdqueue.BACKGROUND), 0)
+
+    def test_background_not_starved(self):
+        self.queue.put(read(POWER), cmdqueue.BACKGROUND)
+        for service_id in range(2, 6):
+            self.queue.put(read(service_id), cmdqueue.INTERACTIVE)
+        order = [self.queue.get_nowait().lane for _ in range(3)]
+        self.assertEqual(order, [cmdqueue.INTERACTIVE, cmdqueue.INTERACTIVE,
+                                 cmdqueue.BACKGROUND])
+
+    def test_read_joins_the_one_in_flight_until_finished(self):
+        cmd = self.queue.put(read(OPMODE))
+        self.assertIs(self.queue.get_nowait(), cmd)
+        self.queue.sent(cmd)
+        self.assertIs(self.queue.put(read(OPMODE), waiter='late'), cmd)
+        self.assertEqual(len(self.queue), 0)
+        self.assertIs(self.queue.finished(cmd.key), cmd)
+        self.assertIsNot(self.queue.put(read(OPMODE)), cmd)
+
+    def test_type_0_reads_do_not_join_in_flight(self):
+        cmd = self.queue.put(read(taiseia101._srv_Register, taiseia101._type_Register))
+        self.queue.get_nowait()
+        self.queue.sent(cmd)
+        self.assertIsNot(self.queue.put(read(taiseia101._srv_Register,
+                                             taiseia101._type_Register)), cmd)
+
+    def test_writes_do_not_join_in_flight(self):
+        cmd = self.queue.put(write(OPMODE, 1))
+        self.queue.get_nowait()
+        self.queue.sent(cmd)
+        self.assertIsNot(self.queue.put(write(OPMODE, 1)), cmd)
+
+class SerialDeviceMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.ser = FakeSerial()
+        self.device = gateway.SerialDevice(
+            self.loop, 'dev', self.ser,
+            compile_command=dehumiditifer.command_registry().compile,
+            parse_frame=dehumiditifer.parse_response_bytes)
+
+    def tearDown(self):
+        self.device.stop()
+        self.loop.close()
+
+    def run_pending(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def test_identical_reads_share_one_round_trip(self):
+        futures = [self.device.submit('opmode') for _ in range(3)]
+        self.assertEqual(len(self.ser.written), 1)
+        self.device.serial_received(response(TYPE, OPMODE, 2))
+        self.run_pending()
+        self.assertEqual([f.result().value for f in futures], [2, 2, 2])
+        self.device.submit('opmode')
+        self.assertEqual(len(self.ser.written), 2)
+
+    def test_queued_reads_merge_behind_another_request(self):
+        self.device.submit('power')
+        futures = [self.device.submit('opmode') for _ in range(2)]
+        self.assertEqual(len(self.ser.written), 1)
+        self.device.serial_received(response(TYPE, POWER, 1))
+        self.run_pending()
+        self.assertEqual(len(self.ser.written), 2)
+        self.device.serial_received(response(TYPE, OPMODE, 3))
+        self.run_pending()
+        self.assertEqual([f.result().value for f in futures], [3, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import unittest
+from taiseia101 import taiseia101
+from taiseia101 import dehumiditifer
+from taiseia101 import eventloop
+from taiseia101 import gateway
+from taiseia101 import cmdqueue
+from taiseia101 import shadow
+
+TYPE = taiseia101._type_Dehumiditifer
+OPMODE = dehumiditifer._srv_OpModeConfig
+
+def response(type_id, service_id, value):
+    frame = bytearray([6, type_id, service_id, (value & 0xff00) >> 8, value & 0xff, 0])
+    frame[-1] = taiseia101.calc_check_sum(frame[:-1])
+    return bytes(frame)
+
+class FakeSerial(object):
+    """records what the device writes, nothing is read back by itself"""
+
+    port = 'fake'
+    baudrate = 9600
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+class DeviceShadowTest(unittest.TestCase):
+
+    def test_entry_expires_after_ttl(self):
+        sh = shadow.DeviceShadow(ttl=5.0)
+        sh.update(TYPE, OPMODE, 2, now=100.0)
+        self.assertEqual(sh.get(TYPE, OPMODE, now=104.0).value, 2)
+        self.assertIsNone(sh.get(TYPE, OPMODE, now=106.0))
+        self.assertEqual((sh.hits, sh.misses), (1, 1))
+
+    def test_stale_only_lists_entries_read_since_update(self):
+        sh = shadow.DeviceShadow(ttl=5.0)
+        sh.update(TYPE, OPMODE, 2, now=100.0)
+        sh.update(TYPE, 0, 1, now=100.0)
+        sh.get(TYPE, OPMODE, now=101.0)
+        self.assertEqual(sh.stale(now=106.0), [(TYPE, OPMODE)])
+
+class SerialDeviceShadowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.ser = FakeSerial()
+        self.device = gateway.SerialDevice(
+            self.loop, 'dev', self.ser,
+            compile_command=dehumiditifer.command_registry().compile,
+            parse_frame=dehumiditifer.parse_response_bytes,
+            shadow_ttl=60)
+
+    def tearDown(self):
+        self.device.stop()
+        self.loop.close()
+
+    def run_pending(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def read(self, use_shadow=True):
+        return self.device.submit_frame(taiseia101.encode_request(TYPE, True, OPMODE),
+                                        use_shadow=use_shadow, lane=cmdqueue.INTERACTIVE
+                                        if use_shadow else cmdqueue.BACKGROUND)
+
+    def answer(self, value):
+        self.device.serial_received(response(TYPE, OPMODE, value))
+        self.run_pending()
+
+    def test_read_answered_from_shadow(self):
+        first = self.read()
+        self.answer(1)
+        self.assertEqual(first.result().value, 1)
+        second = self.read()
+        self.assertEqual(second.result().value, 1)
+        self.assertEqual(len(self.ser.written), 1)
+
+    def test_background_read_keeps_the_shadow_value(self):
+        self.read()
+        self.answer(1)
+        # shadow refresh and polling send reads with use_shadow=False;
+        # their 0xffff placeholder is no value
+        self.read(use_shadow=False)
+        self.assertEqual(len(self.ser.written), 2)
+        self.assertEqual(self.read().result().value, 1)
+
+    def test_write_is_answered_optimistically(self):
+        write = self.device.submit('opmode 2')
+        self.assertIsNotNone(write)
+        self.assertEqual(self.read().result().value, 2)
+
+    def test_shadow_answer_leaves_request_frame_cache_alone(self):
+        self.device.submit('opmode 3')
+        cached = len(taiseia101._frame_cache)
+        pocket = self.read().result()
+        self.assertEqual(pocket.value, 3)
+        self.assertEqual(taiseia101.calc_check_sum(pocket.bytes[:-1]), pocket.bytes[-1])
+        self.assertEqual(len(taiseia101._frame_cache), cached)
+
+if __name__ == '__main__':
+    unittest.main()